@@ -1,5 +1,4 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, session
-from werkzeug.utils import secure_filename
+from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, session, Response, stream_with_context
 import os
 import sqlite3
 import json
@@ -9,7 +8,6 @@ from docx import Document
 from openpyxl import load_workbook, Workbook
 from pathlib import Path
 import shutil
-import zipfile
 import pandas as pd
 import webbrowser
 import threading
@@ -18,10 +16,30 @@ import sys
 import hashlib
 import hmac
 import base64
+import io
+import uuid
+from urllib.parse import quote, urlencode
+from collections import deque
 
 # 导入用户认证模块
 from auth import UserManager, login_required, permission_required, admin_required
 
+# 导入文档渲染模块
+from render_engine import (
+    template_cache, render_options, render_template_file, RENDERABLE_TYPES, RenderContext, build_render_plan,
+    dump_render_plan, load_render_plan, normalize_docx_template, render_pool
+)
+
+# 导入后台任务模块
+from batch_jobs import BatchJobManager, FAILURE_TAIL_SIZE
+from batch_archive import ArchiveWriter, archive_options, stream_zip
+from output_cache import BlobStore, OutputCache, compute_cache_key, file_sha256
+from render_scheduler import RenderStats, schedule_longest_first
+from compatibility import (
+    CompatibilityMatrix, ReadinessCache, TemplateDependencyIndex, VariableMatcher, changed_variables,
+    get_project_variables, match_template_variables
+)
+
 # 获取应用程序的实际路径（支持PyInstaller打包）
 def get_app_path():
     if getattr(sys, 'frozen', False):
@@ -41,6 +59,55 @@ app.config['UPLOAD_FOLDER'] = os.path.join(app_path, 'uploads')
 app.config['OUTPUT_FOLDER'] = os.path.join(app_path, 'output')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_EXTENSIONS'] = ['.docx', '.doc', '.xlsx', '.xls', '.csv']
+# 批量生成时每次读取的项目数：项目数据按块读取和渲染，内存占用与批量大小无关
+app.config['BATCH_CHUNK_SIZE'] = int(os.environ.get('BATCH_CHUNK_SIZE', '500'))
+# 模板缓存上限（MB），可通过环境变量调整
+app.config['TEMPLATE_CACHE_MAX_MB'] = int(os.environ.get('TEMPLATE_CACHE_MAX_MB', '256'))
+template_cache.set_max_bytes(app.config['TEMPLATE_CACHE_MAX_MB'] * 1024 * 1024)
+# Word渲染引擎：python-docx（默认）或 ooxml（直接改写XML部件，适合图片较多的模板）
+app.config['DOCX_RENDER_ENGINE'] = os.environ.get('DOCX_RENDER_ENGINE', 'python-docx')
+render_options['docx_engine'] = app.config['DOCX_RENDER_ENGINE']
+# Excel渲染引擎：openpyxl（默认）或 ooxml（只改写共享字符串表，其余部件原样复制）
+app.config['XLSX_RENDER_ENGINE'] = os.environ.get('XLSX_RENDER_ENGINE', 'openpyxl')
+render_options['xlsx_engine'] = app.config['XLSX_RENDER_ENGINE']
+# 批量生成的并行进程数：1为在请求线程中顺序生成（默认），大于1时使用进程池并行生成
+app.config['BATCH_WORKERS'] = int(os.environ.get('BATCH_WORKERS', '1'))
+render_pool.set_workers(app.config['BATCH_WORKERS'])
+# 批量生成时同时在途（已渲染到内存、尚未写入压缩包）的文件数上限，限制内存占用
+app.config['BATCH_INFLIGHT_WINDOW'] = int(os.environ.get('BATCH_INFLIGHT_WINDOW', '8'))
+render_pool.set_window(app.config['BATCH_INFLIGHT_WINDOW'])
+# 并行生成时按估算耗时从长到短提交任务（设为0时按项目顺序提交）
+app.config['BATCH_LONGEST_FIRST'] = os.environ.get('BATCH_LONGEST_FIRST', '1') != '0'
+# 批量压缩包中直接存储（不再压缩）的扩展名，逗号分隔；其余文件在线程中并行压缩
+app.config['ARCHIVE_STORE_EXTENSIONS'] = os.environ.get(
+    'ARCHIVE_STORE_EXTENSIONS', ','.join(sorted(archive_options['store_extensions'])))
+archive_options['store_extensions'] = {
+    ext.strip().lower() for ext in app.config['ARCHIVE_STORE_EXTENSIONS'].split(',') if ext.strip()}
+app.config['ARCHIVE_COMPRESS_THREADS'] = int(os.environ.get('ARCHIVE_COMPRESS_THREADS',
+                                                            str(archive_options['compress_threads'])))
+archive_options['compress_threads'] = app.config['ARCHIVE_COMPRESS_THREADS']
+
+# 生成文件缓存：模板和项目数据都未变化时直接复用上次生成的文件（设为0关闭）
+app.config['OUTPUT_CACHE_ENABLED'] = os.environ.get('OUTPUT_CACHE_ENABLED', '1') != '0'
+
+# 项目可用模板列表的响应缓存条目数（每个项目一条）
+app.config['READINESS_CACHE_SIZE'] = int(os.environ.get('READINESS_CACHE_SIZE', '1024'))
+readiness_cache = ReadinessCache(app.config['READINESS_CACHE_SIZE'])
+
+# 更新项目后在后台重新生成引用了变化变量的已生成文件（设为1开启）
+app.config['AUTO_REGENERATE_ON_UPDATE'] = os.environ.get('AUTO_REGENERATE_ON_UPDATE', '0') == '1'
+
+# 后台批量任务管理器（任务状态保存在数据库中）
+batch_job_manager = BatchJobManager(os.path.join(app_path, 'system.db'))
+
+# 生成文件的内容寻址存储（保存在输出目录的.blobs子目录中，项目目录中的文件是指向它的硬链接）
+blob_store = BlobStore(os.path.join(app.config['OUTPUT_FOLDER'], '.blobs'))
+
+# 生成文件缓存（缓存内容保存在内容寻址存储中）
+output_cache = OutputCache(os.path.join(app_path, 'system.db'), blob_store, enabled=app.config['OUTPUT_CACHE_ENABLED'])
+
+# 各模板的历史渲染耗时，用于批量生成时估算任务耗时
+render_stats = RenderStats(os.path.join(app_path, 'system.db'))
 
 # 确保必要的目录存在
 for folder in ['uploads', 'output']:
@@ -78,16 +145,27 @@ def get_storage_usage():
                 except OSError:
                     pass
     
-    # 计算输出文件夹大小
+    # 计算输出文件夹大小：项目文件与内容寻址存储共用数据（硬链接），同一份数据只计算一次
     output_folder = app.config['OUTPUT_FOLDER']
+    dedup_saved_size = 0  # 内容相同的项目文件共用一份数据节省的空间
+    seen_files = set()
+    seen_project_files = set()
     if os.path.exists(output_folder):
         for root, dirs, files in os.walk(output_folder):
             for file in files:
                 file_path = os.path.join(root, file)
                 try:
-                    output_size += os.path.getsize(file_path)
+                    file_stat = os.stat(file_path)
                 except OSError:
-                    pass
+                    continue
+                file_key = (file_stat.st_dev, file_stat.st_ino)
+                if not blob_store.is_blob(file_path):
+                    if file_key in seen_project_files:
+                        dedup_saved_size += file_stat.st_size
+                    seen_project_files.add(file_key)
+                if file_key not in seen_files:
+                    seen_files.add(file_key)
+                    output_size += file_stat.st_size
     
     total_size = upload_size + output_size
     
@@ -95,11 +173,18 @@ def get_storage_usage():
         'upload_size': upload_size,
         'output_size': output_size,
         'total_size': total_size,
+        'dedup_saved_size': dedup_saved_size,
         'upload_size_mb': round(upload_size / (1024 * 1024), 2),
         'output_size_mb': round(output_size / (1024 * 1024), 2),
-        'total_size_mb': round(total_size / (1024 * 1024), 2)
+        'total_size_mb': round(total_size / (1024 * 1024), 2),
+        'dedup_saved_size_mb': round(dedup_saved_size / (1024 * 1024), 2)
     }
 
+# 回收内容寻址存储中已无人使用的数据
+def collect_blob_garbage():
+    """删除没有项目文件链接、也不被生成文件缓存引用的内容，返回(删除数量, 释放字节数)"""
+    return blob_store.collect_garbage(output_cache.referenced_paths())
+
 # 数据库连接函数
 def get_db_connection():
     db_path = os.path.join(app_path, 'system.db')
@@ -134,6 +219,7 @@ def init_db():
             variables_count INTEGER DEFAULT 0,
             created_by INTEGER,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            render_plan TEXT,
             FOREIGN KEY (created_by) REFERENCES users (id)
         )
     ''')
@@ -184,6 +270,53 @@ def init_db():
         )
     ''')
     
+    # 后台任务表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            id TEXT PRIMARY KEY,
+            job_type TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            params TEXT,
+            total INTEGER DEFAULT 0,
+            done INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            failures TEXT,
+            result TEXT,
+            download_url TEXT,
+            message TEXT,
+            created_by INTEGER,
+            created_at TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (created_by) REFERENCES users (id)
+        )
+    ''')
+    
+    # 生成文件缓存索引表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS output_cache (
+            cache_key TEXT PRIMARY KEY,
+            project_id INTEGER,
+            template_id INTEGER,
+            file_path TEXT NOT NULL,
+            file_size INTEGER,
+            created_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_output_cache_project ON output_cache (project_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_output_cache_template ON output_cache (template_id)')
+    
+    # 模板渲染耗时统计表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS template_render_stats (
+            template_id INTEGER PRIMARY KEY,
+            render_count INTEGER NOT NULL DEFAULT 0,
+            avg_seconds REAL NOT NULL,
+            last_seconds REAL,
+            updated_at TIMESTAMP
+        )
+    ''')
+    
     # 激活码表
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS activation_codes (
@@ -412,8 +545,50 @@ def init_db():
     except Exception as e:
         print(f'模板数据库迁移警告: {e}')
     
+    # 数据库迁移：为模板表添加渲染计划字段
+    try:
+        cursor.execute("ALTER TABLE templates ADD COLUMN render_plan TEXT")
+        print('已为templates表添加render_plan字段')
+    except sqlite3.OperationalError:
+        pass  # 字段已存在
+    
+    # 数据库迁移：为现有模板生成渲染计划
+    cursor.execute('''
+        SELECT id, file_path, file_type FROM templates
+        WHERE render_plan IS NULL AND file_type IN ('.docx', '.xlsx')
+    ''')
+    for template_id, file_path, file_type in cursor.fetchall():
+        if not os.path.exists(file_path):
+            continue
+        try:
+            render_plan = dump_render_plan(build_render_plan(file_path, file_type))
+            cursor.execute('UPDATE templates SET render_plan = ? WHERE id = ?', (render_plan, template_id))
+        except Exception as e:
+            print(f'模板 {template_id} 渲染计划生成失败: {e}')
+    
+    # 数据库迁移：为模板表添加内容哈希字段（生成文件缓存的键）
+    try:
+        cursor.execute("ALTER TABLE templates ADD COLUMN content_hash TEXT")
+        print('已为templates表添加content_hash字段')
+    except sqlite3.OperationalError:
+        pass  # 字段已存在
+    
+    # 数据库升级：后台任务表记录失败总数（failures字段只保留最近的失败）
+    try:
+        cursor.execute("ALTER TABLE batch_jobs ADD COLUMN failed INTEGER DEFAULT 0")
+    except sqlite3.OperationalError:
+        pass  # 字段已存在
+    
+    cursor.execute('SELECT id, file_path FROM templates WHERE content_hash IS NULL')
+    for template_id, file_path in cursor.fetchall():
+        if file_path and os.path.exists(file_path):
+            cursor.execute('UPDATE templates SET content_hash = ? WHERE id = ?', (file_sha256(file_path), template_id))
+    
     conn.commit()
     conn.close()
+    
+    # 上次运行中未结束的后台任务已无法继续
+    batch_job_manager.mark_interrupted()
 
 # 激活码验证类
 class ActivationValidator:
@@ -817,179 +992,6 @@ def extract_variables_from_file(file_path, file_type):
     
     return list(variables)
 
-# 数字转人民币大写函数
-def number_to_chinese_currency(num):
-    """将数字转换为人民币大写格式"""
-    try:
-        # 处理字符串输入，去除可能的货币符号和空格
-        if isinstance(num, str):
-            num = num.replace('￥', '').replace('¥', '').replace(',', '').strip()
-            if not num:
-                return ''
-        
-        # 转换为浮点数
-        amount = float(num)
-        
-        # 处理负数
-        if amount < 0:
-            return '负' + number_to_chinese_currency(-amount)
-        
-        # 处理零
-        if amount == 0:
-            return '零元整'
-        
-        # 中文数字映射
-        chinese_nums = ['零', '壹', '贰', '叁', '肆', '伍', '陆', '柒', '捌', '玖']
-        chinese_units = ['', '拾', '佰', '仟', '万', '拾', '佰', '仟', '亿']
-        
-        # 分离整数和小数部分
-        integer_part = int(amount)
-        decimal_part = round((amount - integer_part) * 100)
-        
-        result = ''
-        
-        # 处理整数部分
-        if integer_part == 0:
-            result = '零元'
-        else:
-            # 转换整数部分
-            integer_str = str(integer_part)
-            length = len(integer_str)
-            
-            for i, digit in enumerate(integer_str):
-                digit_num = int(digit)
-                pos = length - i - 1
-                
-                if digit_num != 0:
-                    result += chinese_nums[digit_num]
-                    if pos > 0:
-                        if pos == 4:  # 万位
-                            result += '万'
-                        elif pos == 8:  # 亿位
-                            result += '亿'
-                        else:
-                            result += chinese_units[pos % 4]
-                else:
-                    # 处理零的情况
-                    if pos == 4 and result and not result.endswith('万'):
-                        result += '万'
-                    elif pos == 8 and result and not result.endswith('亿'):
-                        result += '亿'
-                    elif i < length - 1 and int(integer_str[i + 1]) != 0 and not result.endswith('零'):
-                        result += '零'
-            
-            result += '元'
-        
-        # 处理小数部分（角分）
-        if decimal_part == 0:
-            result += '整'
-        else:
-            jiao = decimal_part // 10
-            fen = decimal_part % 10
-            
-            if jiao > 0:
-                result += chinese_nums[jiao] + '角'
-            
-            if fen > 0:
-                if jiao == 0:
-                    result += '零'
-                result += chinese_nums[fen] + '分'
-            
-            if jiao > 0 and fen == 0:
-                result += '整'
-        
-        return result
-        
-    except (ValueError, TypeError):
-        # 如果转换失败，返回原值
-        return str(num)
-
-# 替换模板变量的辅助函数
-def replace_template_variables(text, project_data):
-    """替换文本中的模板变量，支持固定列名映射和大写转换"""
-    if not text or not isinstance(text, str):
-        return text
-    
-    # 固定列名映射：模板变量名 -> 项目数据中的实际变量名
-    fixed_column_mapping = {
-        '项目名称': '填报项目名称',
-        '系统项目名称': '填报项目名称'
-        # 注意：合同编号相关变量不在此处映射，应直接使用用户定义的变量名
-    }
-    
-    result_text = text
-    
-    # 首先处理固定列名映射
-    for template_var, actual_var in fixed_column_mapping.items():
-        if f'{{{{{template_var}}}}}' in result_text and actual_var in project_data:
-            result_text = result_text.replace(f'{{{{{template_var}}}}}', str(project_data[actual_var]))
-    
-    # 然后处理其他变量
-    for var_name, var_value in project_data.items():
-        if f'{{{{{var_name}}}}}' in result_text:
-            # 检查变量名是否包含"大写"，如果包含则转换为人民币大写
-            if '大写' in var_name:
-                converted_value = number_to_chinese_currency(var_value)
-                result_text = result_text.replace(f'{{{{{var_name}}}}}', converted_value)
-            else:
-                result_text = result_text.replace(f'{{{{{var_name}}}}}', str(var_value))
-    
-    return result_text
-
-# 保持格式的Word文档变量替换函数
-def replace_variables_in_paragraph(paragraph, project_data):
-    """在段落中替换变量，保持原有格式"""
-    # 固定列名映射
-    fixed_column_mapping = {
-        '项目名称': '填报项目名称',
-        '系统项目名称': '填报项目名称'
-        # 注意：合同编号相关变量不在此处映射，应直接使用用户定义的变量名
-    }
-    
-    # 合并所有数据
-    all_data = dict(project_data)
-    for template_var, actual_var in fixed_column_mapping.items():
-        if actual_var in project_data:
-            all_data[template_var] = project_data[actual_var]
-    
-    # 查找段落中的所有变量
-    full_text = paragraph.text
-    pattern = r'\{\{([^}]+)\}\}'
-    matches = re.findall(pattern, full_text)
-    
-    if not matches:
-        return
-    
-    # 执行替换
-    new_text = full_text
-    for var_name in matches:
-        var_placeholder = f'{{{{{var_name}}}}}'
-        if var_name in all_data:
-            # 检查是否需要转换为大写
-            if '大写' in var_name:
-                replacement_value = number_to_chinese_currency(all_data[var_name])
-            else:
-                replacement_value = str(all_data[var_name])
-            new_text = new_text.replace(var_placeholder, replacement_value)
-    
-    # 如果文本发生了变化，更新段落
-    if new_text != full_text:
-        # 清除所有runs的文本
-        for run in paragraph.runs:
-            run.text = ''
-        
-        # 在第一个run中设置新文本
-        if paragraph.runs:
-            paragraph.runs[0].text = new_text
-        else:
-            # 如果没有runs，创建一个新的
-            paragraph.add_run(new_text)
-
-def replace_variables_in_table_cell(cell, project_data):
-    """在表格单元格中替换变量，保持原有格式"""
-    for paragraph in cell.paragraphs:
-        replace_variables_in_paragraph(paragraph, project_data)
-
 # 记录操作日志
 def log_operation(operation_type, description, user_name=None):
     from flask import session
@@ -1049,28 +1051,22 @@ def index():
     # 管理员可以查看所有项目，普通用户只能查看自己创建的项目
     if current_user_role == 'admin':
         cursor.execute('''
-            SELECT p.id, p.name, p.contract_number, p.updated_at,
-                   COUNT(DISTINCT tv.variable_name) as template_count
-            FROM projects p
-            LEFT JOIN project_data pd ON p.id = pd.project_id
-            LEFT JOIN template_variables tv ON tv.variable_name = pd.variable_name
-            GROUP BY p.id
-            ORDER BY p.updated_at DESC
+            SELECT id, name, contract_number, updated_at FROM projects
+            ORDER BY updated_at DESC
         ''')
     else:
         cursor.execute('''
-            SELECT p.id, p.name, p.contract_number, p.updated_at,
-                   COUNT(DISTINCT tv.variable_name) as template_count
-            FROM projects p
-            LEFT JOIN project_data pd ON p.id = pd.project_id
-            LEFT JOIN template_variables tv ON tv.variable_name = pd.variable_name
-            WHERE p.created_by = ?
-            GROUP BY p.id
-            ORDER BY p.updated_at DESC
+            SELECT id, name, contract_number, updated_at FROM projects
+            WHERE created_by = ?
+            ORDER BY updated_at DESC
         ''', (current_user_id,))
     
     projects = cursor.fetchall()
     
+    # 关联模板数由兼容性矩阵一次计算
+    template_counts = load_compatibility_matrix(cursor, [p[0] for p in projects]).project_related_counts()
+    projects = [tuple(p) + (template_counts.get(p[0], 0),) for p in projects]
+    
     conn.close()
     return render_template('index.html', projects=projects)
 
@@ -1144,9 +1140,26 @@ def upload_template():
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], safe_filename)
         file.save(file_path)
         
+        # 规整Word模板，使每个变量只位于一个run中，生成文件时无需重建段落
+        if file_ext == '.docx':
+            try:
+                normalize_docx_template(file_path)
+            except Exception as e:
+                print(f'模板规整失败: {e}')
+        
         # 提取变量
         variables = extract_variables_from_file(file_path, file_ext)
         
+        # 记录变量所在位置，生成文件时只访问这些位置
+        try:
+            render_plan = dump_render_plan(build_render_plan(file_path, file_ext))
+        except Exception as e:
+            print(f'渲染计划生成失败: {e}')
+            render_plan = None
+        
+        # 模板内容哈希（规整后计算），模板文件变化时生成文件缓存自动失效
+        content_hash = file_sha256(file_path)
+        
         # 保存到数据库
         conn = get_db_connection()
         cursor = conn.cursor()
@@ -1155,9 +1168,10 @@ def upload_template():
         current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         current_user_id = session.get('user_id')
         cursor.execute('''
-            INSERT INTO templates (name, filename, file_path, file_type, variables_count, created_by, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (template_name or original_filename, safe_filename, file_path, file_ext, len(variables), current_user_id, current_time))
+            INSERT INTO templates (name, filename, file_path, file_type, variables_count, created_by, created_at, render_plan, content_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (template_name or original_filename, safe_filename, file_path, file_ext, len(variables), current_user_id, current_time,
+              render_plan, content_hash))
         
         template_id = cursor.lastrowid
         
@@ -1179,6 +1193,9 @@ def upload_template():
         conn.commit()
         conn.close()
         
+        # 新模板加入所有项目的可用模板列表
+        readiness_cache.bump_templates()
+        
         # 记录日志（注意：trial_limit装饰器不会重复记录）
         log_operation('模板上传', f'上传模板: {template_name or original_filename}, 包含{len(variables)}个变量')
         
@@ -1355,7 +1372,15 @@ def update_variable(variable_id):
         ''', (name, data_type, example_value, is_required, description, variable_id))
         
         # 如果变量名称发生变化，需要更新相关表中的引用
+        affected_project_ids = []
+        affected_template_ids = []
         if name != old_name:
+            # 引用该变量的项目和模板，其生成文件缓存需要失效
+            cursor.execute('SELECT DISTINCT project_id FROM project_data WHERE variable_name = ?', (old_name,))
+            affected_project_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute('SELECT DISTINCT template_id FROM template_variables WHERE variable_name = ?', (old_name,))
+            affected_template_ids = [row[0] for row in cursor.fetchall()]
+            
             # 更新template_variables表
             cursor.execute('''
                 UPDATE template_variables 
@@ -1372,6 +1397,12 @@ def update_variable(variable_id):
         
         conn.commit()
         
+        output_cache.invalidate(project_ids=affected_project_ids, template_ids=affected_template_ids)
+        if name != old_name:
+            # 变量名影响所有项目的模板匹配结果
+            readiness_cache.bump_projects(affected_project_ids)
+            readiness_cache.bump_templates()
+        
         # 记录操作日志
         cursor.execute('''
             INSERT INTO operation_logs (operation_type, description, created_at)
@@ -1474,171 +1505,376 @@ def projects():
     if current_user_role == 'admin':
         cursor.execute('''
             SELECT p.id, p.name, p.contract_number, p.created_at,
-                   COUNT(DISTINCT tv.template_id) as template_count,
                    u.username as creator_name
             FROM projects p
-            LEFT JOIN project_data pd ON p.id = pd.project_id
-            LEFT JOIN template_variables tv ON pd.variable_name = tv.variable_name
             LEFT JOIN users u ON p.created_by = u.id
-            GROUP BY p.id, p.name, p.contract_number, p.created_at, u.username
             ORDER BY p.created_at DESC
         ''')
     else:
         cursor.execute('''
             SELECT p.id, p.name, p.contract_number, p.created_at,
-                   COUNT(DISTINCT tv.template_id) as template_count,
                    u.username as creator_name
             FROM projects p
-            LEFT JOIN project_data pd ON p.id = pd.project_id
-            LEFT JOIN template_variables tv ON pd.variable_name = tv.variable_name
             LEFT JOIN users u ON p.created_by = u.id
             WHERE p.created_by = ?
-            GROUP BY p.id, p.name, p.contract_number, p.created_at, u.username
             ORDER BY p.created_at DESC
         ''', (current_user_id,))
     
     projects = cursor.fetchall()
     
+    # 关联模板数由兼容性矩阵一次计算（插入到创建者之前，与页面使用的列顺序一致）
+    template_counts = load_compatibility_matrix(cursor, [p[0] for p in projects]).project_related_counts()
+    projects = [tuple(p[:4]) + (template_counts.get(p[0], 0),) + tuple(p[4:]) for p in projects]
+    
     conn.close()
     return render_template('projects.html', projects=projects)
 
-# 导入模板API
-@app.route('/batch_generate_files', methods=['POST'])
-@trial_limit(max_count=5, feature_name="批量生成文件")
-def batch_generate_files():
-    data = request.get_json()
-    project_ids = data.get('project_ids', [])
-    
-    if not project_ids:
-        return jsonify({'success': False, 'message': '没有选择项目'})
-    
+# SQLite单条语句的参数个数有上限（旧版本为999），IN查询按块执行
+SQL_IN_CHUNK_SIZE = 500
+
+def iter_chunks(items, size=SQL_IN_CHUNK_SIZE):
+    """按固定大小切分列表"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def fetch_unowned_project_ids(cursor, project_ids):
+    """返回当前用户无权访问的项目ID（管理员可访问全部项目，普通用户只能访问自己创建的项目；不存在的项目不在其中）"""
+    if session.get('role') == 'admin':
+        return []
+    unowned = []
+    for chunk in iter_chunks(list(dict.fromkeys(project_ids))):
+        cursor.execute(f"SELECT id, created_by FROM projects WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+        unowned.extend(project_id for project_id, created_by in cursor.fetchall()
+                       if created_by != session.get('user_id'))
+    return unowned
+
+def fetch_projects_with_data(cursor, project_ids):
+    """批量读取项目基本信息和项目数据（每块两条查询），返回 {项目ID: (项目名称, 备注说明, 项目数据字典)}"""
+    projects = {}
+    for chunk in iter_chunks(list(dict.fromkeys(project_ids))):
+        placeholders = ', '.join('?' * len(chunk))
+        cursor.execute(f'SELECT id, name, contract_number FROM projects WHERE id IN ({placeholders})', chunk)
+        for project_id, name, contract_number in cursor.fetchall():
+            projects[project_id] = (name, contract_number, {})
+        cursor.execute(f'''
+            SELECT project_id, variable_name, variable_value FROM project_data
+            WHERE project_id IN ({placeholders})
+        ''', chunk)
+        for project_id, variable_name, variable_value in cursor.fetchall():
+            projects[project_id][2][variable_name] = variable_value
+    return projects
+
+def batch_output_filename(template_name, file_type):
+    """批量生成的文件名：模板名称加扩展名（避免重复后缀）"""
+    if template_name.lower().endswith(file_type):
+        return template_name
+    return f"{template_name}{file_type}"
+
+# 批量生成：准备渲染任务
+def prepare_batch_jobs(cursor, project_ids, templates, keep_files=True, render_plans=None, template_variables=None):
+    """为每个(项目, 模板)生成渲染任务，返回(任务列表, 失败列表)；keep_files为False时不在输出目录保存文件
+
+    传入template_variables（{模板ID: 需要的变量}）时只为变量齐全的模板生成任务，匹配规则与项目可用模板列表相同
+    """
+    # 渲染计划只解析一次，所有项目共用
+    if render_plans is None:
+        render_plans = {template[0]: load_render_plan(template[5]) for template in templates}
+    
+    # 预先批量读取所有项目的信息和数据，避免逐个项目查询
+    projects = fetch_projects_with_data(cursor, project_ids)
+    
+    jobs = []
+    failures = []
+    for project_id in project_ids:
+        if project_id not in projects:
+            failures.append({'project_id': project_id, 'template_id': None, 'template_name': None,
+                             'error': '项目不存在'})
+            continue
+        
+        project_name, contract_number, project_data = projects[project_id]
+        if template_variables is not None:
+            project_variables = VariableMatcher(get_project_variables(project_data, project_name, contract_number))
+        project_data = dict(project_data)
+        
+        # 添加项目基本信息到数据字典中
+        project_data['填报项目名称'] = project_name
+        project_data['备注说明'] = contract_number or ''
+        
+        # 构建渲染上下文，该项目的所有模板共用
+        render_context = RenderContext(project_data)
+        
+        for template in templates:
+            template_id, template_name, template_filename, template_path, file_type, _, content_hash = template
+            if file_type not in ['.docx', '.xlsx']:
+                continue
+            # 跳过项目缺少变量的模板
+            if template_variables is not None and \
+                    match_template_variables(template_variables.get(template_id, ()), project_variables)[1]:
+                continue
+            
+            output_filename = batch_output_filename(template_name, file_type)
+            # 压缩包内路径与输出目录结构一致：P###/模板名称/文件名
+            arcname = f'P{project_id:03d}/{template_name}/{output_filename}'
+            
+            output_path = None
+            if keep_files:
+                # 创建项目输出目录
+                output_path = os.path.normpath(os.path.join(app.config['OUTPUT_FOLDER'], arcname))
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            
+            jobs.append({
+                'project_id': project_id,
+                'template_id': template_id,
+                'template_name': template_name,
+                'template_path': template_path,
+                'file_type': file_type,
+                'project_data': render_context,
+                'output_path': output_path,
+                'arcname': arcname,
+                'render_plan': render_plans[template_id],
+                'cache_key': compute_cache_key(content_hash, file_type, project_data) if content_hash else None
+            })
+    return jobs, failures
+
+def iter_batch_job_chunks(project_ids, templates, keep_files=True, only_compatible=False):
+    """按块准备渲染任务，返回(本块项目ID, 任务列表, 失败列表)的迭代器
+
+    每块只读取BATCH_CHUNK_SIZE个项目的数据，调用方处理完一块再读取下一块，内存占用与批量大小无关；
+    only_compatible为True时跳过项目缺少变量的模板
+    """
+    render_plans = {template[0]: load_render_plan(template[5]) for template in templates}
+    template_variables = None
+    if only_compatible:
+        conn = get_db_connection()
+        try:
+            template_variables = fetch_template_variables(conn.cursor(), [template[0] for template in templates])
+        finally:
+            conn.close()
+    for chunk in iter_chunks(project_ids, app.config['BATCH_CHUNK_SIZE']):
+        # 每块使用独立的连接，不在渲染期间占用数据库
+        conn = get_db_connection()
+        try:
+            jobs, failures = prepare_batch_jobs(conn.cursor(), chunk, templates, keep_files, render_plans,
+                                                template_variables)
+        finally:
+            conn.close()
+        yield chunk, jobs, failures
+
+def fetch_batch_templates(cursor, template_ids=None):
+    """读取批量生成使用的模板，template_ids为空时使用全部模板"""
+    query = 'SELECT id, name, filename, file_path, file_type, render_plan, content_hash FROM templates'
+    if not template_ids:
+        cursor.execute(query)
+        return cursor.fetchall()
+    templates = []
+    for chunk in iter_chunks(list(dict.fromkeys(template_ids))):
+        cursor.execute(f"{query} WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+        templates.extend(cursor.fetchall())
+    return sorted(templates, key=lambda template: template[0])
+
+def batch_archive_filename(current_time, job_id=None):
+    """批量压缩包文件名：生成时间加任务ID（没有任务时为随机ID），同一秒开始的批量生成不会使用同一个文件"""
+    return f"批量生成文件_{current_time.strftime('%Y%m%d_%H%M%S')}_{(job_id or uuid.uuid4().hex)[:8]}.zip"
+
+def count_batch_templates(templates):
+    """每个项目需要生成的模板数"""
+    return len([template for template in templates if template[4] in ['.docx', '.xlsx']])
+
+def run_render_jobs(jobs):
+    """执行渲染任务并按完成顺序返回结果：生成文件缓存命中的任务直接返回缓存内容，其余任务交给渲染执行器
+
+    输出目录中的文件统一由内容寻址存储写入（内容相同的文件只保存一份），新渲染的结果写入缓存；
+    缓存命中的结果带有cached标记。并行生成时按估算耗时从长到短提交任务，各模板的渲染耗时记入统计表
+    """
+    # 一块任务的缓存只查询一次数据库
+    cache_paths = output_cache.get_paths(job.get('cache_key') for job in jobs)
+    pending_jobs = []
+    for job in jobs:
+        cache_path = cache_paths.get(job.get('cache_key'))
+        if cache_path is None:
+            pending_jobs.append(job)
+            continue
+        result = {
+            'project_id': job['project_id'],
+            'template_id': job['template_id'],
+            'output_path': job['output_path'],
+            'arcname': job.get('arcname'),
+            'success': True,
+            'cached': True
+        }
+        try:
+            if job['output_path']:
+                blob_store.link(cache_path, job['output_path'])
+            if job.get('return_data'):
+                with open(cache_path, 'rb') as f:
+                    result['data'] = f.read()
+        except OSError as e:
+            result['success'] = False
+            result['error'] = str(e)
+        yield result
+    
+    if not pending_jobs:
+        return
+    if render_pool.workers > 1 and app.config['BATCH_LONGEST_FIRST'] and len(pending_jobs) > 1:
+        pending_jobs = schedule_longest_first(
+            pending_jobs, render_stats.averages(job['template_id'] for job in pending_jobs))
+    # 渲染进程返回文件内容和内容摘要（摘要在工作进程中并行计算），由当前进程写入内容寻址存储
+    jobs_by_key = {(job['project_id'], job['template_id']): job for job in pending_jobs}
+    results = render_pool.run([dict(job, output_path=None, return_data=True, digest=True) for job in pending_jobs])
+    render_seconds = {}
+    cache_entries = []    # 本块新生成的缓存，结束时在一个事务中写入
+    try:
+        for result in results:
+            job = jobs_by_key[(result['project_id'], result['template_id'])]
+            result['output_path'] = job['output_path']
+            if 'render_seconds' in result:
+                render_seconds.setdefault(result['template_id'], []).append(result.pop('render_seconds'))
+            if result['success']:
+                data = result['data'] if job.get('return_data') else result.pop('data')
+                digest = result.pop('digest', None)
+                try:
+                    blob_path = None
+                    if job['output_path']:
+                        blob_path = blob_store.write(job['output_path'], data, digest)
+                    if output_cache.enabled and job.get('cache_key'):
+                        blob_path = blob_path or blob_store.put(data, digest)
+                        cache_entries.append((job['cache_key'], job['project_id'], job['template_id'], blob_path))
+                except OSError as e:
+                    result['success'] = False
+                    result['error'] = str(e)
+                    result.pop('data', None)
+            yield result
+    finally:
+        results.close()
+        # 缓存索引和耗时统计写入失败不影响已生成的文件
+        try:
+            output_cache.put_many(cache_entries)
+        except (sqlite3.Error, OSError) as e:
+            print(f'生成文件缓存写入失败: {e}')
+        try:
+            render_stats.record(render_seconds)
+        except sqlite3.Error as e:
+            print(f'渲染耗时统计写入失败: {e}')
+
+def run_batch_generation(project_ids, progress=None, keep_files=True, template_ids=None, only_compatible=False):
+    """为多个项目批量生成模板文件并打包，返回结果字典；progress为后台任务的进度记录器
+
+    keep_files为False时只生成压缩包，各文件在内存中渲染后直接写入压缩包，不在输出目录保存；
+    template_ids为空时生成全部模板，only_compatible为True时跳过项目缺少变量的模板
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        success_count = 0
-        fail_count = 0
-        generated_files = []
         current_time = datetime.now()
         
-        # 获取所有可用模板
-        cursor.execute('SELECT id, name, filename, file_path, file_type FROM templates')
-        templates = cursor.fetchall()
+        # 获取选择的模板（未选择时为所有可用模板）
+        templates = fetch_batch_templates(cursor, template_ids)
         
         if not templates:
-            conn.close()
-            return jsonify({'success': False, 'message': '系统中没有可用的模板'})
+            if template_ids:
+                return {'success': False, 'message': '选择的模板不存在'}
+            return {'success': False, 'message': '系统中没有可用的模板'}
+        
+        template_names = {template[0]: template[1] for template in templates}
+        templates_per_project = count_batch_templates(templates)
+        total_files = len(project_ids) * templates_per_project
+        # 只保留最近的失败信息，失败项目数按块累计，内存占用与批量大小无关
+        failures = deque(maxlen=FAILURE_TAIL_SIZE)
+        fail_count = 0
         
-        for project_id in project_ids:
-            try:
-                # 获取项目信息
-                cursor.execute('SELECT id, name, contract_number FROM projects WHERE id = ?', (project_id,))
-                project = cursor.fetchone()
-                
-                if not project:
-                    fail_count += 1
-                    continue
-                
-                project_id_val, project_name, contract_number = project
+        if progress:
+            progress.set_total(total_files)
+        
+        zip_filename = batch_archive_filename(current_time, progress.job_id if progress else None)
+        output_dir = app.config['OUTPUT_FOLDER']
+        os.makedirs(output_dir, exist_ok=True)
+        zip_path = os.path.normpath(os.path.join(output_dir, zip_filename))
+        
+        # 按块读取项目数据并渲染，每块的结果写入压缩包后再读取下一块，内存占用与项目数量无关
+        # （缓存命中的文件直接复用；其余按BATCH_WORKERS配置顺序执行或进程池并行，在途文件数受BATCH_INFLIGHT_WINDOW限制）
+        generated_count = 0
+        cached_count = 0
+        skipped_count = 0
+        projects_done = 0
+        archive = ArchiveWriter(zip_path)
+        try:
+            for chunk, jobs, chunk_failures in iter_batch_job_chunks(project_ids, templates, keep_files,
+                                                                     only_compatible):
+                failures.extend(chunk_failures)
+                failed_projects = {failure['project_id'] for failure in chunk_failures}
+                # 缺少变量而跳过的模板数
+                chunk_skipped = (len(chunk) - len(chunk_failures)) * templates_per_project - len(jobs)
+                skipped_count += chunk_skipped
                 
-                # 获取项目数据
-                cursor.execute('SELECT variable_name, variable_value FROM project_data WHERE project_id = ?', (project_id,))
-                project_data = dict(cursor.fetchall())
+                # 每个项目剩余的任务数，全部完成时发布项目完成事件
+                remaining_jobs = {}
+                for job in jobs:
+                    remaining_jobs[job['project_id']] = remaining_jobs.get(job['project_id'], 0) + 1
+                    # 渲染结果直接在内存中写入压缩包，keep_files为True时同时保存到输出目录
+                    job['return_data'] = True
                 
-                # 添加项目基本信息到数据字典中
-                project_data['填报项目名称'] = project_name
-                project_data['备注说明'] = contract_number or ''
+                if progress:
+                    # 不存在的项目和跳过的模板没有生成任务
+                    progress.total -= len(chunk_failures) * templates_per_project + chunk_skipped
+                    for failure in chunk_failures:
+                        progress.add_failure(failure)
+                    # 没有生成任务的项目（不存在或全部模板被跳过）直接完成
+                    projects_done += len([project_id for project_id in chunk if project_id not in remaining_jobs])
+                    if projects_done:
+                        progress.emit_throttled('project_done', {'projects_done': projects_done})
                 
-                # 为每个模板生成文件
-                for template in templates:
-                    template_id, template_name, template_filename, template_path, file_type = template
-
-                    
-                    try:
-                        # 获取模板需要的变量（不再检查是否缺少变量，允许使用默认值）
-                        cursor.execute('SELECT variable_name FROM template_variables WHERE template_id = ?', (template_id,))
-                        required_vars = [row[0] for row in cursor.fetchall()]
-                        
-                        # 创建项目输出目录
-                        output_base_dir = app.config['OUTPUT_FOLDER']
-                        os.makedirs(output_base_dir, exist_ok=True)
-                        project_output_dir = os.path.normpath(os.path.join(output_base_dir, f'P{project_id_val:03d}'))
-                        template_output_dir = os.path.normpath(os.path.join(project_output_dir, template_name))
-                        os.makedirs(template_output_dir, exist_ok=True)
-                        
-                        # 生成文件
-                        if file_type == '.docx':
-                            # 处理Word文档，保持原有格式
-                            doc = Document(template_path)
-                            
-                            # 替换段落中的变量，保持格式
-                            for paragraph in doc.paragraphs:
-                                replace_variables_in_paragraph(paragraph, project_data)
-                            
-                            # 替换表格中的变量，保持格式
-                            for table in doc.tables:
-                                for row in table.rows:
-                                    for cell in row.cells:
-                                        replace_variables_in_table_cell(cell, project_data)
-                            
-                            # 保存文档
-                            # 避免重复后缀
-                            if template_name.lower().endswith('.docx'):
-                                output_filename = template_name
-                            else:
-                                output_filename = f"{template_name}.docx"
-                            output_path = os.path.normpath(os.path.join(template_output_dir, output_filename))
-                            doc.save(output_path)
-                            generated_files.append(output_path)
-                            
-                        elif file_type == '.xlsx':
-                            # 处理Excel文档
-                            wb = load_workbook(template_path)
-                            
-                            for sheet in wb.worksheets:
-                                for row in sheet.iter_rows():
-                                    for cell in row:
-                                        if cell.value and isinstance(cell.value, str):
-                                            cell.value = replace_template_variables(cell.value, project_data)
-                            
-                            # 保存文档
-                            # 避免重复后缀
-                            if template_name.lower().endswith('.xlsx'):
-                                output_filename = template_name
-                            else:
-                                output_filename = f"{template_name}.xlsx"
-                            output_path = os.path.normpath(os.path.join(template_output_dir, output_filename))
-                            wb.save(output_path)
-                            generated_files.append(output_path)
-                    
-                    except Exception as template_error:
-                        continue
-                
-                success_count += 1
-                
-            except Exception as project_error:
-
-                fail_count += 1
-                continue
-        
-        # 创建批量下载压缩包
+                results = run_render_jobs(jobs)
+                try:
+                    for result in results:
+                        failure = None
+                        if result['success']:
+                            archive.add(result['arcname'], result['data'])
+                            generated_count += 1
+                            if result.get('cached'):
+                                cached_count += 1
+                        else:
+                            failure = {
+                                'project_id': result['project_id'],
+                                'template_id': result['template_id'],
+                                'template_name': template_names.get(result['template_id']),
+                                'error': result['error']
+                            }
+                            failures.append(failure)
+                            failed_projects.add(result['project_id'])
+                        if progress:
+                            # 每个文件、每个项目的事件按时间间隔合并，事件数与批量大小无关
+                            if result['success']:
+                                progress.emit_throttled('zip_progress', {
+                                    'files_written': archive.files_written,
+                                    'total_files': progress.total,
+                                    'bytes_written': archive.bytes_written
+                                })
+                            remaining_jobs[result['project_id']] -= 1
+                            if remaining_jobs[result['project_id']] == 0:
+                                projects_done += 1
+                                progress.emit_throttled('project_done', {'projects_done': projects_done})
+                            progress.advance(failure)
+                            progress.check_cancelled()
+                finally:
+                    results.close()
+                fail_count += len([project_id for project_id in chunk if project_id in failed_projects])
+            archive.close()
+        except BaseException:
+            # 取消或出错时删除不完整的压缩包
+            archive.abort()
+            if os.path.exists(zip_path):
+                os.remove(zip_path)
+            raise
+        
+        success_count = len(project_ids) - fail_count
+        
+        # 批量下载压缩包
         download_url = None
-        if generated_files:
-            zip_filename = f"批量生成文件_{current_time.strftime('%Y%m%d_%H%M%S')}.zip"
-            output_dir = app.config['OUTPUT_FOLDER']
-            os.makedirs(output_dir, exist_ok=True)
-            zip_path = os.path.normpath(os.path.join(output_dir, zip_filename))
-            
-            try:
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for file_path in generated_files:
-                        # 计算相对路径
-                        rel_path = os.path.relpath(file_path, app.config['OUTPUT_FOLDER'])
-                        zipf.write(file_path, rel_path)
-                
-                download_url = f'/download_batch_files/{zip_filename}'
-            except Exception as zip_error:
-                pass  # 静默处理ZIP创建错误
+        if generated_count:
+            download_url = f'/download_batch_files/{zip_filename}'
+        else:
+            os.remove(zip_path)
         
         # 记录操作日志
         cursor.execute('''
@@ -1646,25 +1882,295 @@ def batch_generate_files():
             VALUES (?, ?, ?)
         ''', (
             '批量生成文件',
-            f'批量生成文件: 成功 {success_count} 个项目，失败 {fail_count} 个项目，共生成 {len(generated_files)} 个文件',
+            f'批量生成文件: 成功 {success_count} 个项目，失败 {fail_count} 个项目，共生成 {generated_count} 个文件'
+            f'（其中 {cached_count} 个复用缓存，跳过 {skipped_count} 个缺少变量的模板）',
             current_time.strftime('%Y-%m-%d %H:%M:%S')
         ))
         conn.commit()
-        conn.close()
         
-        return jsonify({
+        return {
             'success': True,
             'message': f'批量生成文件完成',
             'success_count': success_count,
             'fail_count': fail_count,
-            'generated_files_count': len(generated_files),
+            'generated_files_count': generated_count,
+            'cached_files_count': cached_count,
+            'skipped_files_count': skipped_count,
+            'failures': list(failures),
             'download_url': download_url
-        })
-        
-    except Exception as e:
+        }
+    
+    finally:
+        conn.close()
+
+def build_batch_manifest(project_ids, template_ids=None, only_compatible=False):
+    """按需生成模式：不渲染任何文件，返回每个文件的下载地址，文件在首次下载时生成并写入生成文件缓存"""
+    conn = get_db_connection()
+    try:
+        templates = fetch_batch_templates(conn.cursor(), template_ids)
+    finally:
         conn.close()
+    
+    if not templates:
+        if template_ids:
+            return {'success': False, 'message': '选择的模板不存在'}
+        return {'success': False, 'message': '系统中没有可用的模板'}
+    
+    templates_per_project = count_batch_templates(templates)
+    files = []
+    # 只保留最近的失败信息（每个失败对应一个不存在的项目），失败项目数单独累计
+    failures = deque(maxlen=FAILURE_TAIL_SIZE)
+    fail_count = 0
+    skipped_count = 0
+    for chunk, jobs, chunk_failures in iter_batch_job_chunks(project_ids, templates, keep_files=False,
+                                                             only_compatible=only_compatible):
+        failures.extend(chunk_failures)
+        fail_count += len(chunk_failures)
+        skipped_count += (len(chunk) - len(chunk_failures)) * templates_per_project - len(jobs)
+        for job in jobs:
+            filename = job['arcname'].rsplit('/', 1)[1]
+            files.append({
+                'project_id': job['project_id'],
+                'template_id': job['template_id'],
+                'template_name': job['template_name'],
+                'arcname': job['arcname'],
+                'download_url': f"/download/{job['project_id']}/{job['template_id']}/{quote(filename)}"
+            })
+    
+    # 全部下载：流式压缩包，已按需生成的文件直接复用缓存
+    query = {'project_ids': ','.join(str(project_id) for project_id in project_ids)}
+    if template_ids:
+        query['template_ids'] = ','.join(str(template_id) for template_id in template_ids)
+    if only_compatible:
+        query['only_compatible'] = '1'
+    
+    log_operation('批量生成文件', f'按需生成模式: {len(project_ids)} 个项目，共 {len(files)} 个文件（首次下载时生成）')
+    
+    return {
+        'success': True,
+        'message': '下载清单已生成，文件在首次下载时生成',
+        'lazy': True,
+        'total_files': len(files),
+        'skipped_files_count': skipped_count,
+        'fail_count': fail_count,
+        'files': files,
+        'failures': list(failures),
+        'download_all_url': f'/batch_generate_files/stream?{urlencode(query)}'
+    }
+
+@app.route('/batch_generate_files', methods=['POST'])
+@trial_limit(max_count=5, feature_name="批量生成文件")
+def batch_generate_files():
+    data = request.get_json()
+    try:
+        # 页面提交的项目ID为字符串
+        project_ids = [int(pid) for pid in data.get('project_ids', [])]
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': '项目ID格式错误'})
+    
+    if not project_ids:
+        return jsonify({'success': False, 'message': '没有选择项目'})
+    
+    # template_ids为要生成的模板（未传入时生成全部模板），only_compatible为true时跳过项目缺少变量的模板
+    try:
+        template_ids = [int(tid) for tid in data.get('template_ids') or []]
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': '模板ID格式错误'})
+    only_compatible = bool(data.get('only_compatible', False))
+    
+    # keep_files为false时只生成压缩包，不在输出目录保存各项目的文件（也接受字符串"true"/"false"、"1"/"0"）
+    keep_files = data.get('keep_files', True)
+    if isinstance(keep_files, str):
+        keep_files = keep_files.strip().lower() in ('1', 'true')
+    keep_files = bool(keep_files)
+    
+    # 按需生成模式：立即返回下载清单，不预先生成文件
+    if data.get('lazy'):
+        try:
+            return jsonify(build_batch_manifest(project_ids, template_ids, only_compatible))
+        except Exception as e:
+            return jsonify({'success': False, 'message': f'生成下载清单失败: {str(e)}'})
+    
+    # 异步模式：创建后台任务并立即返回任务ID，通过任务状态接口查询进度
+    if data.get('async'):
+        job_id = batch_job_manager.create_job('batch_generate', {
+            'project_ids': project_ids,
+            'template_ids': template_ids,
+            'only_compatible': only_compatible,
+            'keep_files': keep_files
+        }, created_by=session.get('user_id'))
+        batch_job_manager.start(job_id, lambda progress: run_batch_generation(
+            project_ids, progress, keep_files, template_ids, only_compatible))
+        return jsonify({'success': True, 'message': '批量生成任务已创建', 'job_id': job_id})
+    
+    try:
+        return jsonify(run_batch_generation(project_ids, keep_files=keep_files, template_ids=template_ids,
+                                            only_compatible=only_compatible))
+    except Exception as e:
         return jsonify({'success': False, 'message': f'批量生成文件失败: {str(e)}'})
 
+@app.route('/batch_generate_files/stream')
+@login_required
+@trial_limit(max_count=5, feature_name="批量生成文件")
+def stream_batch_generate_files():
+    """批量生成文件并以流式ZIP直接下载：每生成一个文件就写入压缩包发送给浏览器，默认不在磁盘上保存"""
+    try:
+        project_ids = [int(pid) for pid in request.args.get('project_ids', '').split(',') if pid.strip()]
+        template_ids = [int(tid) for tid in request.args.get('template_ids', '').split(',') if tid.strip()]
+    except ValueError:
+        return jsonify({'success': False, 'message': '项目ID或模板ID格式错误'})
+    
+    if not project_ids:
+        return jsonify({'success': False, 'message': '没有选择项目'})
+    
+    # keep_files=1 时同时在输出目录保存各项目的文件，only_compatible=1 时跳过项目缺少变量的模板
+    keep_files = request.args.get('keep_files') == '1'
+    only_compatible = request.args.get('only_compatible') == '1'
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        # 检查权限：普通用户只能下载自己创建的项目的文件
+        if fetch_unowned_project_ids(cursor, project_ids):
+            return jsonify({'success': False, 'message': '无权限下载此项目的文件'}), 403
+        templates = fetch_batch_templates(cursor, template_ids)
+        if not templates:
+            if template_ids:
+                return jsonify({'success': False, 'message': '选择的模板不存在'})
+            return jsonify({'success': False, 'message': '系统中没有可用的模板'})
+    finally:
+        conn.close()
+    
+    template_names = {template[0]: template[1] for template in templates}
+    current_time = datetime.now()
+    
+    def generate_entries():
+        # 按块读取项目数据，按渲染完成顺序写入压缩包，第一个文件完成即开始发送
+        generated_count = 0
+        # 只保留最近的失败信息，失败总数和失败项目数按块累计，内存占用与批量大小无关
+        failures = deque(maxlen=FAILURE_TAIL_SIZE)
+        failure_count = 0
+        fail_count = 0
+        for chunk, jobs, chunk_failures in iter_batch_job_chunks(project_ids, templates, keep_files, only_compatible):
+            failures.extend(chunk_failures)
+            failure_count += len(chunk_failures)
+            failed_projects = {failure['project_id'] for failure in chunk_failures}
+            for job in jobs:
+                job['return_data'] = True
+            results = run_render_jobs(jobs)
+            try:
+                for result in results:
+                    if result['success']:
+                        generated_count += 1
+                        yield result['arcname'], result['data']
+                    else:
+                        failures.append({
+                            'project_id': result['project_id'],
+                            'template_id': result['template_id'],
+                            'template_name': template_names.get(result['template_id']),
+                            'error': result['error']
+                        })
+                        failure_count += 1
+                        failed_projects.add(result['project_id'])
+            finally:
+                results.close()
+            fail_count += len([project_id for project_id in chunk if project_id in failed_projects])
+        
+        # 响应已开始发送，失败信息以清单文件的形式放入压缩包
+        if failures:
+            lines = [f"项目ID {failure['project_id']} / 模板 {failure['template_name'] or '-'}: {failure['error']}"
+                     for failure in failures]
+            if failure_count > len(failures):
+                lines.insert(0, f'共 {failure_count} 项生成失败，以下为最近的 {len(failures)} 项')
+            yield '生成失败清单.txt', '\n'.join(lines)
+        
+        # 记录操作日志
+        log_conn = get_db_connection()
+        try:
+            log_conn.execute('''
+                INSERT INTO operation_logs (operation_type, description, created_at)
+                VALUES (?, ?, ?)
+            ''', (
+                '批量生成文件',
+                f'批量生成文件（流式下载）: 成功 {len(project_ids) - fail_count} 个项目，失败 {fail_count} 个项目，共生成 {generated_count} 个文件',
+                current_time.strftime('%Y-%m-%d %H:%M:%S')
+            ))
+            log_conn.commit()
+        finally:
+            log_conn.close()
+    
+    zip_filename = batch_archive_filename(current_time)
+    return Response(
+        stream_with_context(stream_zip(generate_entries())),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(zip_filename)}",
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+def get_accessible_job(job_id):
+    """获取当前用户可访问的任务（管理员可访问所有任务）"""
+    job = batch_job_manager.get_job(job_id)
+    if not job:
+        return None
+    if session.get('role') != 'admin' and job['created_by'] != session.get('user_id'):
+        return None
+    return job
+
+@app.route('/batch_jobs/<job_id>')
+@login_required
+def get_batch_job(job_id):
+    """查询后台任务状态"""
+    job = get_accessible_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/batch_jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_batch_job(job_id):
+    """取消运行中的后台任务"""
+    job = get_accessible_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    if not batch_job_manager.cancel(job_id):
+        return jsonify({'success': False, 'message': '任务已结束，无法取消'})
+    return jsonify({'success': True, 'message': '已请求取消任务'})
+
+@app.route('/batch_jobs/<job_id>/events')
+@login_required
+def stream_batch_job_events(job_id):
+    """以Server-Sent Events推送后台任务进度，断线重连时从Last-Event-ID之后继续"""
+    if not get_accessible_job(job_id):
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        last_event_id = 0
+    
+    def generate():
+        for item in batch_job_manager.stream_events(job_id, last_event_id):
+            if item is None:
+                yield ': keepalive\n\n'
+                continue
+            event_id, event, data = item
+            message = f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+            yield f'id: {event_id}\n{message}' if event_id is not None else message
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/batch_jobs/active')
+@login_required
+def get_active_batch_jobs():
+    """获取当前用户未结束的后台任务，用于页面刷新后继续显示进度"""
+    job_type = request.args.get('type', 'batch_generate')
+    created_by = None if session.get('role') == 'admin' else session.get('user_id')
+    jobs = batch_job_manager.get_active_jobs(job_type, created_by)
+    return jsonify({'success': True, 'jobs': jobs})
+
 @app.route('/download_batch_files/<filename>')
 def download_batch_files(filename):
     output_dir = app.config['OUTPUT_FOLDER']
@@ -1798,15 +2304,10 @@ def get_template_detail(template_id):
     ''', (template_id,))
     variables = cursor.fetchall()
     
-    # 获取使用该模板的项目数量
-    cursor.execute('''
-        SELECT COUNT(DISTINCT p.id) as project_count
-        FROM projects p
-        JOIN project_data pd ON p.id = pd.project_id
-        JOIN template_variables tv ON pd.variable_name = tv.variable_name
-        WHERE tv.template_id = ?
-    ''', (template_id,))
-    project_count = cursor.fetchone()[0]
+    # 使用该模板的项目数量（关联的项目 / 变量齐全可以生成的项目）
+    matrix = load_compatibility_matrix(cursor, template_ids=[template_id])
+    project_count = matrix.template_related_counts()[template_id]
+    ready_project_count = matrix.template_ready_counts()[template_id]
     
     conn.close()
     
@@ -1820,7 +2321,8 @@ def get_template_detail(template_id):
             'file_type': template[4],
             'variables_count': template[5],
             'created_at': template[6],
-            'project_count': project_count
+            'project_count': project_count,
+            'ready_project_count': ready_project_count
         },
         'variables': [{
             'name': var[0],
@@ -1981,9 +2483,10 @@ def delete_template(template_id):
         # 删除模板变量关联
         cursor.execute('DELETE FROM template_variables WHERE template_id = ?', (template_id,))
         
-        # 删除模板记录
+        # 删除模板记录和渲染耗时统计
         cursor.execute('DELETE FROM templates WHERE id = ?', (template_id,))
-        
+        cursor.execute('DELETE FROM template_render_stats WHERE template_id = ?', (template_id,))
+
         # 删除模板文件
         file_delete_warning = None
         if file_path and os.path.exists(file_path):
@@ -1997,23 +2500,31 @@ def delete_template(template_id):
                 file_delete_warning = f"文件删除失败: {str(file_error)}，数据库记录已删除"
         
         conn.commit()
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'success': False, 'message': f'删除失败: {str(e)}'})
+    finally:
         conn.close()
+    
+    # 模板已删除，以下清理失败不影响删除结果
+    try:
+        readiness_cache.bump_templates()
+        # 提交后再清除模板缓存和生成文件缓存（生成文件缓存使用独立连接，提交前会等待本事务的写锁）
+        template_cache.invalidate(template_id)
+        output_cache.invalidate(template_ids=[template_id])
         
         # 记录日志
         log_operation('模板删除', f'删除模板: {template_name} ({filename})')
-        
-        if file_delete_warning:
-            return jsonify({
-                'success': True, 
-                'message': f'模板删除成功，但{file_delete_warning}'
-            })
-        else:
-            return jsonify({'success': True, 'message': '模板删除成功'})
-        
     except Exception as e:
-        conn.rollback()
-        conn.close()
-        return jsonify({'success': False, 'message': f'删除失败: {str(e)}'})
+        print(f'模板 {template_id} 删除后清理失败: {e}')
+    
+    if file_delete_warning:
+        return jsonify({
+            'success': True, 
+            'message': f'模板删除成功，但{file_delete_warning}'
+        })
+    else:
+        return jsonify({'success': True, 'message': '模板删除成功'})
 
 # 新建项目
 @app.route('/create_project', methods=['POST'])
@@ -2053,6 +2564,7 @@ def create_project():
         
         conn.commit()
         conn.close()
+        readiness_cache.bump_projects([project_id])
         
         # 记录日志
         log_operation('创建项目', f'创建项目: {name}')
@@ -2104,6 +2616,109 @@ def get_project(project_id):
         }
     })
 
+# 变量 → 模板依赖索引，模板版本变化（上传/删除模板、重命名变量）后重新构建
+dependency_index = None
+dependency_index_lock = threading.Lock()
+
+def get_dependency_index():
+    global dependency_index
+    with dependency_index_lock:
+        version = readiness_cache.templates_version
+        if dependency_index is None or dependency_index.version != version:
+            conn = get_db_connection()
+            try:
+                rows = conn.execute('SELECT template_id, variable_name FROM template_variables').fetchall()
+            finally:
+                conn.close()
+            dependency_index = TemplateDependencyIndex(rows, version)
+        return dependency_index
+
+def project_render_data(project_data, project_name, contract_number):
+    """渲染时使用的项目数据（包含项目基本信息）"""
+    render_data = dict(project_data)
+    render_data['填报项目名称'] = project_name
+    render_data['备注说明'] = contract_number or ''
+    return render_data
+
+def existing_output_paths(project_id, template, project_names):
+    """项目已生成的该模板文件：批量生成的文件和单个生成的文件（按项目名称命名）"""
+    template_name, file_type = template[1], template[4]
+    output_dir = os.path.join(app.config['OUTPUT_FOLDER'], f'P{project_id:03d}', template_name)
+    single_template_name = template_name[:-len(file_type)] if template_name.lower().endswith(file_type.lower()) \
+        else template_name
+    filenames = [batch_output_filename(template_name, file_type)]
+    filenames += [f"{name.replace(file_type, '')}_{single_template_name}{file_type}" for name in project_names if name]
+    paths = []
+    for filename in dict.fromkeys(filenames):
+        path = os.path.normpath(os.path.join(output_dir, filename))
+        if os.path.exists(path):
+            paths.append(path)
+    return paths
+
+def run_regeneration(project_id, template_ids, project_names, progress=None):
+    """重新生成项目已生成的指定模板文件（原位置覆盖），返回结果字典"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        templates = [template for template in fetch_batch_templates(cursor, template_ids)
+                     if template[4] in ['.docx', '.xlsx']]
+        # 只重新生成已经生成过的文件
+        output_paths = {template[0]: existing_output_paths(project_id, template, project_names)
+                        for template in templates}
+        templates = [template for template in templates if output_paths[template[0]]]
+        jobs, failures = prepare_batch_jobs(cursor, [project_id], templates, keep_files=False) if templates else ([], [])
+    finally:
+        conn.close()
+    
+    if progress:
+        progress.set_total(len(jobs))
+    # 每个模板渲染一次写入第一个文件，其余文件链接到同一内容
+    for job in jobs:
+        job['output_path'] = output_paths[job['template_id']][0]
+    
+    regenerated_count = 0
+    results = run_render_jobs(jobs)
+    try:
+        for result in results:
+            failure = None
+            if result['success']:
+                try:
+                    for path in output_paths[result['template_id']][1:]:
+                        blob_store.link(result['output_path'], path)
+                    regenerated_count += 1
+                except OSError as e:
+                    failure = {'project_id': project_id, 'template_id': result['template_id'], 'error': str(e)}
+            else:
+                failure = {'project_id': project_id, 'template_id': result['template_id'], 'error': result['error']}
+            if failure:
+                failures.append(failure)
+            if progress:
+                progress.advance(failure)
+                progress.check_cancelled()
+    finally:
+        results.close()
+    
+    return {
+        'success': True,
+        'message': f'已重新生成 {regenerated_count} 个文件',
+        'regenerated_files_count': regenerated_count,
+        'failures': failures
+    }
+
+def schedule_regeneration(project_id, old_data, new_data, project_names, created_by=None):
+    """按修改前后的项目数据找出受影响的模板，创建后台任务重新生成，返回任务ID（没有受影响的模板时返回None）"""
+    template_ids = get_dependency_index().templates_for(changed_variables(old_data, new_data))
+    if not template_ids:
+        return None
+    template_ids = sorted(template_ids)
+    job_id = batch_job_manager.create_job('regenerate', {
+        'project_id': project_id,
+        'template_ids': template_ids
+    }, created_by=created_by)
+    batch_job_manager.start(job_id, lambda progress: run_regeneration(project_id, template_ids, project_names,
+                                                                      progress))
+    return job_id
+
 @app.route('/update_project/<int:project_id>', methods=['POST'])
 @login_required
 @trial_limit(max_count=15, feature_name="项目更新")
@@ -2124,7 +2739,7 @@ def update_project(project_id):
         current_user_role = session.get('role')
         
         # 检查项目是否存在并获取创建者信息
-        cursor.execute('SELECT id, created_by FROM projects WHERE id = ?', (project_id,))
+        cursor.execute('SELECT id, created_by, name, contract_number FROM projects WHERE id = ?', (project_id,))
         project = cursor.fetchone()
         if not project:
             conn.close()
@@ -2135,6 +2750,12 @@ def update_project(project_id):
             conn.close()
             return jsonify({'success': False, 'message': '无权限修改此项目'})
         
+        # 开启自动重新生成时记录修改前的数据，用于找出变化的变量
+        auto_regenerate = app.config['AUTO_REGENERATE_ON_UPDATE']
+        if auto_regenerate:
+            cursor.execute('SELECT variable_name, variable_value FROM project_data WHERE project_id = ?', (project_id,))
+            old_data = project_render_data(dict(cursor.fetchall()), project[2], project[3])
+        
         # 更新项目基本信息（使用本地时间）
         current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         cursor.execute('''
@@ -2147,27 +2768,121 @@ def update_project(project_id):
         cursor.execute('DELETE FROM project_data WHERE project_id = ?', (project_id,))
         
         # 插入新的项目数据
+        new_data = {}
         for variable_name, variable_value in project_data.items():
             if variable_name and variable_value:  # 只插入非空的数据
                 cursor.execute('''
                     INSERT INTO project_data (project_id, variable_name, variable_value)
                     VALUES (?, ?, ?)
                 ''', (project_id, variable_name, variable_value))
+                new_data[variable_name] = variable_value
         
         conn.commit()
         
+        # 项目数据已变化，该项目的生成文件缓存和可用模板列表缓存失效
+        output_cache.invalidate(project_ids=[project_id])
+        readiness_cache.bump_projects([project_id])
+        
+        # 在后台重新生成引用了变化变量的已生成文件
+        regenerate_job_id = None
+        if auto_regenerate:
+            regenerate_job_id = schedule_regeneration(
+                project_id, old_data, project_render_data(new_data, name, contract_number), [project[2], name],
+                created_by=current_user_id)
+        
         # 记录操作日志
         log_operation('项目更新', f'更新项目: {name} (ID: {project_id})')
         
         conn.close()
-        return jsonify({'success': True, 'message': '项目更新成功'})
+        return jsonify({'success': True, 'message': '项目更新成功', 'regenerate_job_id': regenerate_job_id})
         
     except Exception as e:
         return jsonify({'success': False, 'message': f'更新项目失败: {str(e)}'})
 
-# 获取可用模板
-@app.route('/get_templates/<int:project_id>')
-def get_templates_for_project(project_id):
+def fetch_template_variables(cursor, template_ids):
+    """批量读取模板需要的变量，返回 {模板ID: 变量名集合}"""
+    template_variables = {template_id: set() for template_id in template_ids}
+    for chunk in iter_chunks(list(template_ids)):
+        cursor.execute(f'''
+            SELECT template_id, variable_name FROM template_variables
+            WHERE template_id IN ({', '.join('?' * len(chunk))})
+        ''', chunk)
+        for template_id, variable_name in cursor.fetchall():
+            template_variables[template_id].add(variable_name)
+    return template_variables
+
+def load_compatibility_matrix(cursor, project_ids=None, template_ids=None):
+    """读取项目变量和模板变量，构建项目 × 模板兼容性矩阵；project_ids/template_ids为None时包含全部"""
+    if project_ids is None:
+        cursor.execute('SELECT id, name, contract_number FROM projects ORDER BY id')
+        project_rows = cursor.fetchall()
+        cursor.execute('SELECT project_id, variable_name FROM project_data')
+        data_rows = cursor.fetchall()
+    else:
+        project_rows = []
+        data_rows = []
+        for chunk in iter_chunks(list(dict.fromkeys(project_ids))):
+            placeholders = ', '.join('?' * len(chunk))
+            cursor.execute(f'SELECT id, name, contract_number FROM projects WHERE id IN ({placeholders})', chunk)
+            project_rows.extend(cursor.fetchall())
+            cursor.execute(f'SELECT project_id, variable_name FROM project_data WHERE project_id IN ({placeholders})',
+                           chunk)
+            data_rows.extend(cursor.fetchall())
+    
+    data_variables = {row[0]: set() for row in project_rows}
+    for project_id, variable_name in data_rows:
+        if project_id in data_variables:
+            data_variables[project_id].add(variable_name)
+    
+    if template_ids is None:
+        cursor.execute('SELECT id FROM templates ORDER BY id')
+        template_ids = [row[0] for row in cursor.fetchall()]
+    else:
+        existing_ids = set()
+        for chunk in iter_chunks(list(dict.fromkeys(template_ids))):
+            cursor.execute(f"SELECT id FROM templates WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+            existing_ids.update(row[0] for row in cursor.fetchall())
+        template_ids = sorted(existing_ids)
+    template_variables = fetch_template_variables(cursor, template_ids)
+    
+    return CompatibilityMatrix(
+        [(project_id, data_variables[project_id], name, contract_number)
+         for project_id, name, contract_number in project_rows],
+        [(template_id, template_variables[template_id]) for template_id in template_ids]
+    )
+
+# 项目 × 模板兼容性矩阵API
+@app.route('/api/compatibility_matrix')
+@login_required
+def get_compatibility_matrix():
+    """返回项目 × 模板的缺少变量数和能否生成；可用project_ids、template_ids（逗号分隔）限定范围"""
+    try:
+        project_ids = [int(pid) for pid in request.args.get('project_ids', '').split(',') if pid.strip()]
+        template_ids = [int(tid) for tid in request.args.get('template_ids', '').split(',') if tid.strip()]
+    except ValueError:
+        return jsonify({'success': False, 'message': '项目ID或模板ID格式错误'})
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        # 普通用户只能查看自己创建的项目
+        if session.get('role') != 'admin':
+            cursor.execute('SELECT id FROM projects WHERE created_by = ?', (session.get('user_id'),))
+            own_project_ids = [row[0] for row in cursor.fetchall()]
+            own = set(own_project_ids)
+            project_ids = [pid for pid in project_ids if pid in own] if project_ids else own_project_ids
+        else:
+            project_ids = project_ids or None
+        
+        matrix = load_compatibility_matrix(cursor, project_ids, template_ids or None)
+        return jsonify({'success': True, 'matrix': matrix.to_dict()})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'获取兼容性矩阵失败: {str(e)}'})
+    finally:
+        conn.close()
+
+def list_project_templates(project_id):
+    """项目可用模板列表：每个模板需要的变量、已匹配和缺少的变量、能否生成"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -2175,18 +2890,15 @@ def get_templates_for_project(project_id):
     cursor.execute('''
         SELECT variable_name FROM project_data WHERE project_id = ?
     ''', (project_id,))
-    project_variables = set([row[0] for row in cursor.fetchall()])
+    data_variables = [row[0] for row in cursor.fetchall()]
     
     # 获取项目基本信息，添加到变量集合中
     cursor.execute('''
         SELECT name, contract_number FROM projects WHERE id = ?
     ''', (project_id,))
     project_info = cursor.fetchone()
-    if project_info:
-        if project_info[0]:  # 项目名称
-            project_variables.add('填报项目名称')
-        if project_info[1]:  # 合同编号
-            project_variables.add('备注说明')
+    # 构建变量匹配索引，所有模板共用
+    project_variables = VariableMatcher(get_project_variables(data_variables, *(project_info or (None, None))))
     
     # 获取所有模板及其需要的变量
     cursor.execute('''
@@ -2198,60 +2910,10 @@ def get_templates_for_project(project_id):
     ''')
     templates = cursor.fetchall()
     
-    def normalize_variable_name(name):
-        """标准化变量名，去除空格和常见标点符号"""
-        if not name:
-            return ''
-        return re.sub(r'[\s\-_\(\)（）【】\[\]]+', '', name.strip())
-    
-    def find_matching_variable(template_var, project_vars):
-        """查找匹配的项目变量"""
-        template_var_normalized = normalize_variable_name(template_var)
-        
-        # 固定列名映射：模板变量名 -> 项目数据中的实际变量名
-        fixed_column_mapping = {
-            '项目名称': '填报项目名称',
-            '系统项目名称': '填报项目名称'
-            # 注意：合同编号相关变量不在此处映射，应直接使用用户定义的变量名
-            # 备注说明来自项目基本信息，不是变量数据
-        }
-        
-        # 首先检查固定列名映射
-        if template_var in fixed_column_mapping:
-            mapped_var = fixed_column_mapping[template_var]
-            if mapped_var in project_vars:
-                return mapped_var
-        
-        # 首先尝试精确匹配
-        if template_var in project_vars:
-            return template_var
-        
-        # 然后尝试标准化后的匹配
-        for project_var in project_vars:
-            if normalize_variable_name(project_var) == template_var_normalized:
-                return project_var
-        
-        # 最后尝试包含关系匹配
-        for project_var in project_vars:
-            project_var_normalized = normalize_variable_name(project_var)
-            if (template_var_normalized in project_var_normalized or 
-                project_var_normalized in template_var_normalized):
-                return project_var
-        
-        return None
-    
     template_list = []
     for template in templates:
         required_vars = set(template[4].split(',') if template[4] else [])
-        missing_vars = set()
-        matched_vars = set()
-        
-        for required_var in required_vars:
-            matching_project_var = find_matching_variable(required_var, project_variables)
-            if matching_project_var:
-                matched_vars.add(required_var)
-            else:
-                missing_vars.add(required_var)
+        matched_vars, missing_vars = match_template_variables(required_vars, project_variables)
         
         template_list.append({
             'id': template[0],
@@ -2265,7 +2927,26 @@ def get_templates_for_project(project_id):
         })
     
     conn.close()
-    return jsonify({'success': True, 'templates': template_list})
+    return template_list
+
+# 获取可用模板
+@app.route('/get_templates/<int:project_id>')
+def get_templates_for_project(project_id):
+    """结果按项目缓存并带ETag：项目数据、模板和变量名未变化时直接返回缓存，浏览器重新验证时返回304"""
+    cached = readiness_cache.get(project_id)
+    if cached is None:
+        # 先取版本再读取数据，读取期间发生的修改会使这次缓存的结果过期
+        version = readiness_cache.version(project_id)
+        body = jsonify({'success': True, 'templates': list_project_templates(project_id)}).get_data()
+        etag = readiness_cache.put(project_id, version, body)
+    else:
+        etag, body = cached
+    
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # 每次使用前都向服务器验证，内容未变化时只返回304
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 # 删除项目API
 @app.route('/delete_project/<int:project_id>', methods=['DELETE'])
@@ -2312,6 +2993,11 @@ def delete_project(project_id):
         
         conn.commit()
         
+        # 删除该项目的生成文件缓存，以及已没有其他项目使用的共用数据
+        output_cache.invalidate(project_ids=[project_id])
+        collect_blob_garbage()
+        readiness_cache.bump_projects([project_id])
+        
         # 记录操作日志
         cursor.execute('''
             INSERT INTO operation_logs (operation_type, description, created_at)
@@ -2358,7 +3044,7 @@ def generate_file():
         return jsonify({'success': False, 'message': '无权限为此项目生成文件'})
     
     # 获取模板信息
-    cursor.execute('SELECT name, file_path, file_type FROM templates WHERE id = ?', (template_id,))
+    cursor.execute('SELECT name, file_path, file_type, render_plan, content_hash FROM templates WHERE id = ?', (template_id,))
     template = cursor.fetchone()
     if not template:
         return jsonify({'success': False, 'message': '模板不存在'})
@@ -2397,34 +3083,26 @@ def generate_file():
     output_path = os.path.normpath(os.path.join(output_dir, output_filename))
     
     try:
-        if file_type == '.docx':
-            # 处理Word文档，保持原有格式
-            doc = Document(template_path)
-            
-            # 替换段落中的变量，保持格式
-            for paragraph in doc.paragraphs:
-                replace_variables_in_paragraph(paragraph, project_data)
-            
-            # 替换表格中的变量，保持格式
-            for table in doc.tables:
-                for row in table.rows:
-                    for cell in row.cells:
-                        replace_variables_in_table_cell(cell, project_data)
-            
-            doc.save(output_path)
-            
-        elif file_type in ['.xlsx', '.xls']:
-            # 处理Excel文档
-            wb = load_workbook(template_path)
-            
-            for sheet in wb.worksheets:
-                for row in sheet.iter_rows():
-                    for cell in row:
-                        if cell.value and isinstance(cell.value, str):
-                            cell.value = replace_template_variables(cell.value, project_data)
-            
-            wb.save(output_path)
-        
+        cached = False
+        if file_type in RENDERABLE_TYPES:
+            # 模板和项目数据都未变化时直接复用上次生成的文件
+            cache_key = compute_cache_key(template[4], file_type, project_data) if template[4] else None
+            cache_path = output_cache.get_path(cache_key)
+            if cache_path:
+                blob_store.link(cache_path, output_path)
+                cached = True
+            else:
+                # 模板解析结果由模板缓存复用；在内存中渲染后写入内容寻址存储（内容相同的文件只保存一份），
+                # 输出文件可能是其他项目共用内容的硬链接，不能原地改写
+                buffer = io.BytesIO()
+                render_template_file(template_id, template_path, file_type, project_data, buffer,
+                                     load_render_plan(template[3]))
+                blob_path = blob_store.write(output_path, buffer.getvalue())
+                try:
+                    output_cache.put(cache_key, project_id, template_id, blob_path)
+                except Exception as e:
+                    print(f'生成文件缓存写入失败: {e}')
+
         # 更新项目数据（保存额外数据）
         for var_name, var_value in additional_data.items():
             cursor.execute('''
@@ -2434,6 +3112,8 @@ def generate_file():
         
         conn.commit()
         conn.close()
+        if additional_data:
+            readiness_cache.bump_projects([project_id])
         
         # 记录日志
         log_operation('文件生成', f'项目 {project[0]} 使用模板 {template[0]} 生成文件')
@@ -2442,6 +3122,7 @@ def generate_file():
             'success': True,
             'message': '文件生成成功',
             'file_path': output_path,
+            'cached': cached,
             'download_url': f'/download/{project_id}/{template_id}/{output_filename}'
         })
         
@@ -2450,18 +3131,44 @@ def generate_file():
 
 # 文件下载
 @app.route('/download/<int:project_id>/<int:template_id>/<filename>')
+@login_required
 def download_file(project_id, template_id, filename):
+    """下载生成的文件；批量生成的文件（按需生成模式的下载清单）在请求时按生成文件缓存生成或复用"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('SELECT name FROM templates WHERE id = ?', (template_id,))
-    template = cursor.fetchone()
-    
-    if template:
-        file_path = os.path.join(app.config['OUTPUT_FOLDER'], f'P{project_id:03d}', template[0], filename)
-        if os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True)
+    try:
+        # 检查权限：普通用户只能下载自己创建的项目的文件
+        cursor.execute('SELECT created_by FROM projects WHERE id = ?', (project_id,))
+        project = cursor.fetchone()
+        if not project:
+            return '项目不存在', 404
+        if session.get('role') != 'admin' and project[0] != session.get('user_id'):
+            return '无权限下载此项目的文件', 403
+        
+        templates = fetch_batch_templates(cursor, [template_id])
+        if not templates:
+            return '文件不存在', 404
+        template = templates[0]
+        file_path = os.path.join(app.config['OUTPUT_FOLDER'], f'P{project_id:03d}', template[1], filename)
+        
+        # 批量生成的文件：缓存命中时链接缓存内容，否则生成（关闭生成文件缓存时只生成不存在的文件）
+        is_batch_file = template[4] in ['.docx', '.xlsx'] and filename == batch_output_filename(template[1], template[4])
+        if is_batch_file and (output_cache.enabled or not os.path.exists(file_path)):
+            jobs, _ = prepare_batch_jobs(cursor, [project_id], [template])
+            if jobs:
+                results = run_render_jobs(jobs)
+                try:
+                    result = next(results)
+                finally:
+                    results.close()
+                if not result['success']:
+                    return jsonify({'success': False, 'message': f"文件生成失败: {result['error']}"}), 500
+    finally:
+        conn.close()
     
+    if os.path.exists(file_path):
+        return send_file(file_path, as_attachment=True)
     return '文件不存在', 404
 
 # 操作日志
@@ -2650,30 +3357,21 @@ def export_logs():
             'message': f'导出失败: {str(e)}'
         })
 
-# 数据导入
-@app.route('/import_data', methods=['POST'])
-@trial_limit(max_count=3, feature_name="数据导入")
-def import_data():
-    if 'file' not in request.files:
-        return jsonify({'success': False, 'message': '没有选择文件'})
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'success': False, 'message': '没有选择文件'})
-    
-    if file:
-        filename = secure_filename(file.filename)
-        file_path = os.path.join('uploads', filename)
-        file.save(file_path)
+def run_data_import(file_path, user_id, user_name, progress=None):
+    """从Excel文件导入项目数据，返回结果字典；progress为后台任务的进度记录器（取消时不提交任何数据）"""
+    try:
+        # 读取Excel文件
+        df = pd.read_excel(file_path)
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        
+        if progress:
+            progress.set_total(len(df))
         
         try:
-            # 读取Excel文件
-            df = pd.read_excel(file_path)
-            
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
             imported_count = 0
+            imported_project_ids = []
             for index, row in df.iterrows():
                 # 支持新旧列名格式
                 project_name = row.get('填报项目名称', row.get('系统项目名称', row.get('项目名称', f'导入项目{index+1}')))
@@ -2681,11 +3379,10 @@ def import_data():
                 
                 # 插入项目（添加创建者和时间信息）
                 current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                current_user_id = session.get('user_id')
                 cursor.execute('''
                     INSERT INTO projects (name, contract_number, created_by, created_at, updated_at)
                     VALUES (?, ?, ?, ?, ?)
-                ''', (project_name, contract_number, current_user_id, current_time, current_time))
+                ''', (project_name, contract_number, user_id, current_time, current_time))
                 
                 project_id = cursor.lastrowid
                 
@@ -2717,23 +3414,60 @@ def import_data():
                             VALUES (?, ?, ?)
                         ''', (project_id, col_name, str(col_value)))
                 
+                imported_project_ids.append(project_id)
                 imported_count += 1
+                if progress:
+                    progress.advance()
+                    progress.check_cancelled()
             
             conn.commit()
+            readiness_cache.bump_projects(imported_project_ids)
+        finally:
             conn.close()
-            
-            # 删除临时文件
+        
+        # 记录日志
+        log_operation('数据导入', f'导入 {imported_count} 个项目数据', user_name=user_name)
+        
+        return {
+            'success': True,
+            'message': f'成功导入 {imported_count} 个项目',
+            'count': imported_count
+        }
+    
+    finally:
+        # 删除临时文件
+        if os.path.exists(file_path):
             os.remove(file_path)
-            
-            # 记录日志
-            log_operation('数据导入', f'导入 {imported_count} 个项目数据')
-            
-            return jsonify({
-                'success': True,
-                'message': f'成功导入 {imported_count} 个项目',
-                'count': imported_count
-            })
-            
+
+# 数据导入
+@app.route('/import_data', methods=['POST'])
+@trial_limit(max_count=3, feature_name="数据导入")
+def import_data():
+    if 'file' not in request.files:
+        return jsonify({'success': False, 'message': '没有选择文件'})
+    
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'success': False, 'message': '没有选择文件'})
+    
+    if file:
+        # 使用唯一的临时文件名，避免同时导入时互相覆盖
+        import uuid
+        file_ext = os.path.splitext(file.filename)[1].lower()
+        file_path = os.path.join('uploads', f'import_{uuid.uuid4().hex}{file_ext}')
+        file.save(file_path)
+        
+        user_id = session.get('user_id')
+        user_name = session.get('username', '系统用户')
+        
+        # 异步模式：创建后台任务并立即返回任务ID，通过进度事件获取导入进度
+        if request.form.get('async'):
+            job_id = batch_job_manager.create_job('import_data', {'filename': file.filename}, created_by=user_id)
+            batch_job_manager.start(job_id, lambda progress: run_data_import(file_path, user_id, user_name, progress))
+            return jsonify({'success': True, 'message': '导入任务已创建', 'job_id': job_id})
+        
+        try:
+            return jsonify(run_data_import(file_path, user_id, user_name))
         except Exception as e:
             return jsonify({'success': False, 'message': f'导入失败: {str(e)}'})
 
@@ -2918,14 +3652,20 @@ def get_export_files():
         output_dir = app.config['OUTPUT_FOLDER']
         files_info = []
         total_size = 0
+        seen_files = set()
         
         if os.path.exists(output_dir):
             for root, dirs, files in os.walk(output_dir):
+                # 不列出内容寻址存储等内部目录
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
                 for file in files:
                     file_path = os.path.join(root, file)
                     file_stat = os.stat(file_path)
                     file_size = file_stat.st_size
-                    total_size += file_size
+                    # 内容相同的文件共用一份数据，总大小只计算一次
+                    if (file_stat.st_dev, file_stat.st_ino) not in seen_files:
+                        seen_files.add((file_stat.st_dev, file_stat.st_ino))
+                        total_size += file_size
                     
                     # 获取相对路径
                     rel_path = os.path.relpath(file_path, output_dir)
@@ -2976,6 +3716,9 @@ def delete_export_file():
             elif os.path.isdir(full_path):
                 shutil.rmtree(full_path)
             
+            # 删除已没有其他文件使用的共用数据
+            collect_blob_garbage()
+            
             return jsonify({'success': True, 'message': '文件删除成功'})
         else:
             return jsonify({'success': False, 'message': '文件不存在'})
@@ -2998,6 +3741,10 @@ def clean_export_files():
             current_time = datetime.now()
             
             for root, dirs, files in os.walk(output_dir, topdown=False):
+                # 内容寻址存储等内部目录只在清理全部文件时删除，其余情况由垃圾回收处理
+                is_internal = os.path.relpath(root, output_dir).startswith('.') and root != output_dir
+                if clean_type != 'all' and is_internal:
+                    continue
                 for file in files:
                     file_path = os.path.join(root, file)
                     file_stat = os.stat(file_path)
@@ -3012,9 +3759,12 @@ def clean_export_files():
                         should_delete = days_old >= 7
                     
                     if should_delete:
-                        deleted_size += file_stat.st_size
+                        # 与其他文件共用数据（硬链接）时，删除最后一个链接才释放空间
+                        if file_stat.st_nlink <= 1:
+                            deleted_size += file_stat.st_size
                         os.remove(file_path)
-                        deleted_count += 1
+                        if not is_internal:
+                            deleted_count += 1
                 
                 # 删除空目录
                 for dir_name in dirs:
@@ -3024,6 +3774,13 @@ def clean_export_files():
                             os.rmdir(dir_path)
                     except OSError:
                         pass  # 目录不为空或其他错误，忽略
+            
+            if clean_type == 'all':
+                # 缓存内容已删除，同时清空缓存索引
+                output_cache.clear()
+            else:
+                # 删除已没有项目文件使用、也不被缓存引用的内容
+                deleted_size += collect_blob_garbage()[1]
         
         # 根据删除的文件数量提供不同的消息
         if deleted_count == 0:
@@ -3349,6 +4106,10 @@ def setup_console_handler():
         pass  # 忽略设置错误
 
 if __name__ == '__main__':
+    # 打包环境下进程池的工作进程需要此调用
+    import multiprocessing
+    multiprocessing.freeze_support()
+    
     init_db()
     
     # 检查是否为打包环境或Docker环境
@@ -0,0 +1,185 @@
+import os
+import struct
+import tempfile
+import time
+import zlib
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from render_engine import write_raw_entry
+
+# 压缩包配置（按部署调整）
+# store_extensions: 直接存储不再压缩的扩展名（本身已是压缩格式，直接存储打包快得多，但压缩包通常大10%-30%）
+# compress_threads: 需要压缩的条目在线程中并行压缩（zlib压缩时释放GIL），默认为CPU核数（最多4个）
+# compress_level: 压缩级别
+archive_options = {
+    'store_extensions': {'.docx', '.xlsx', '.xlsm', '.pptx', '.zip', '.png', '.jpg', '.jpeg', '.gif', '.pdf'},
+    'compress_threads': min(4, os.cpu_count() or 1),
+    'compress_level': 6
+}
+
+def archive_compression(arcname):
+    """按扩展名决定条目的压缩方式"""
+    if os.path.splitext(arcname)[1].lower() in archive_options['store_extensions']:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def build_entry(arcname, data):
+    """生成压缩包条目，返回(ZipInfo, 写入的数据)；可在线程中执行"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    info = zipfile.ZipInfo(arcname, time.localtime()[:6])
+    info.external_attr = 0o600 << 16
+    info.file_size = len(data)
+    info.CRC = zlib.crc32(data) & 0xffffffff
+    info.compress_type = archive_compression(arcname)
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(archive_options['compress_level'], zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    info.compress_size = len(data)
+    return info, data
+
+class CentralDirectorySpool:
+    """压缩包中央目录记录暂存区：代替ZipFile.filelist，已写入条目的信息保存到临时文件，不常驻内存
+
+    关闭压缩包时zipfile按顺序遍历本对象写出中央目录，每次只还原一个ZipInfo
+    """
+
+    # 修改时间(6) 压缩方式 标志位 CRC 压缩后大小 原始大小 本地头偏移 解压版本 创建版本 外部属性 文件名长度
+    _RECORD = struct.Struct('<6HHHIQQQHHIH')
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._count = 0
+
+    def append(self, info):
+        filename = info.filename.encode('utf-8')
+        self._file.write(self._RECORD.pack(
+            *info.date_time, info.compress_type, info.flag_bits, info.CRC, info.compress_size, info.file_size,
+            info.header_offset, info.extract_version, info.create_version, info.external_attr, len(filename)
+        ) + filename)
+        self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        self._file.seek(0)
+        for _ in range(self._count):
+            fields = self._RECORD.unpack(self._file.read(self._RECORD.size))
+            info = zipfile.ZipInfo(self._file.read(fields[-1]).decode('utf-8'), fields[:6])
+            (info.compress_type, info.flag_bits, info.CRC, info.compress_size, info.file_size, info.header_offset,
+             info.extract_version, info.create_version, info.external_attr) = fields[6:-1]
+            yield info
+        self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        self._file.close()
+
+class ArchiveWriter:
+    """批量压缩包写入器：已压缩格式直接存储，其余条目在线程池中并行压缩，按添加顺序写入
+
+    已写入条目的中央目录记录暂存到临时文件，内存占用与条目数量无关
+    """
+
+    def __init__(self, file, threads=None):
+        self.zf = zipfile.ZipFile(file, 'w')
+        self._central_directory = CentralDirectorySpool()
+        self.zf.filelist = self._central_directory
+        threads = archive_options['compress_threads'] if threads is None else threads
+        self._executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self._max_pending = max(1, threads) * 2  # 等待写入的条目数上限，限制内存占用
+        self._pending = deque()
+        self.files_written = 0
+
+    @property
+    def bytes_written(self):
+        return self.zf.fp.tell()
+
+    def add(self, arcname, data):
+        """添加一个文件，需要压缩的条目提交到线程池"""
+        if self._executor is None or archive_compression(arcname) == zipfile.ZIP_STORED:
+            # 直接存储的条目无需压缩，等之前提交的条目写完后立即写入
+            self._write_ready(wait_all=True)
+            self._write(*build_entry(arcname, data))
+            return
+        self._pending.append(self._executor.submit(build_entry, arcname, data))
+        self._write_ready()
+
+    def _write(self, info, data):
+        write_raw_entry(self.zf, info, data)
+        # 不保留文件名索引（批量压缩包的条目名称不重复，只在中央目录中记录）
+        self.zf.NameToInfo.pop(info.filename, None)
+        self.files_written += 1
+
+    def _write_ready(self, wait_all=False):
+        """按添加顺序写入已压缩完成的条目；等待中的条目过多或wait_all时阻塞等待"""
+        while self._pending and (wait_all or self._pending[0].done() or len(self._pending) > self._max_pending):
+            self._write(*self._pending.popleft().result())
+
+    def close(self):
+        """写入剩余条目和中央目录"""
+        try:
+            self._write_ready(wait_all=True)
+            self.zf.close()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._central_directory.close()
+
+    def abort(self):
+        """放弃尚未写入的条目并关闭压缩包（取消或出错时，调用方负责删除不完整的文件）"""
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        try:
+            self.zf.close()
+        except Exception:
+            pass
+        self._central_directory.close()
+
+class StreamBuffer:
+    """只写缓冲区：zipfile写入的数据暂存于此，由生成器取出后发送给客户端"""
+
+    def __init__(self):
+        self._chunks = []
+        self.bytes_written = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.bytes_written += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """取出并清空已写入的数据"""
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def stream_zip(entries):
+    """边生成边输出ZIP压缩包：entries为(压缩包内路径, 文件内容)的迭代器，条目写入后即返回已生成的数据块
+
+    每个条目的大小和CRC在写入前已计算好，输出无需回退定位
+    """
+    buffer = StreamBuffer()
+    writer = ArchiveWriter(buffer)
+    try:
+        for arcname, data in entries:
+            writer.add(arcname, data)
+            chunk = buffer.drain()
+            if chunk:
+                yield chunk
+    except BaseException:
+        writer.abort()
+        raise
+    # 剩余条目和中央目录
+    writer.close()
+    chunk = buffer.drain()
+    if chunk:
+        yield chunk
@@ -0,0 +1,321 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+
+# 任务状态
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_COMPLETED = 'completed'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+ACTIVE_STATUSES = (JOB_PENDING, JOB_RUNNING)
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 每个任务在内存中保留的最近事件数：断线重连时已被淘汰的事件以一条状态快照代替
+EVENT_LOG_SIZE = 1000
+# 进度记录中保留的最近失败数（失败总数单独记录）
+FAILURE_TAIL_SIZE = 100
+
+class JobCancelled(Exception):
+    """任务已被取消"""
+
+class JobEventLog:
+    """单个任务的进度事件记录，供SSE连接按事件序号读取；只保留最近max_events个事件，内存占用与任务规模无关"""
+
+    def __init__(self, max_events=EVENT_LOG_SIZE):
+        self.events = deque(maxlen=max_events)  # [(事件序号, 事件类型, 数据)]
+        self.last_id = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    @property
+    def first_id(self):
+        """保留的最早事件序号（没有事件时为下一个事件的序号）"""
+        return self.events[0][0] if self.events else self.last_id + 1
+
+    def publish(self, event, data):
+        with self.condition:
+            self.last_id += 1
+            self.events.append((self.last_id, event, data))
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class JobProgress:
+    """任务进度记录器，由后台任务调用；数据库写入和进度事件按时间间隔合并"""
+
+    def __init__(self, manager, job_id):
+        self.manager = manager
+        self.job_id = job_id
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.failures = deque(maxlen=FAILURE_TAIL_SIZE)  # 最近的失败信息
+        self._last_flush = 0
+        self._last_emit = {}    # 高频事件类型 -> 上次发布时间
+        self._held_events = {}  # 间隔内未发布的高频事件（只保留最新一条）
+
+    @property
+    def cancelled(self):
+        return self.manager.is_cancel_requested(self.job_id)
+
+    def check_cancelled(self):
+        """任务被取消时抛出JobCancelled"""
+        if self.cancelled:
+            raise JobCancelled()
+
+    def set_total(self, total):
+        self.total = total
+        self.flush()
+
+    def add_failure(self, failure):
+        """记录一项失败（不计入完成数）"""
+        self.failed += 1
+        self.failures.append(failure)
+
+    def advance(self, failure=None):
+        """完成一项，failure为失败信息（成功时为None）"""
+        self.done += 1
+        if failure:
+            self.add_failure(failure)
+            self.emit('template_failed', failure)
+        if time.time() - self._last_flush >= self.manager.update_interval or self.done >= self.total:
+            self.flush()
+
+    def emit(self, event, data):
+        """发布进度事件"""
+        self.manager.publish(self.job_id, event, data)
+
+    def emit_throttled(self, event, data):
+        """发布高频事件（如每个文件、每个项目）：同类事件每update_interval秒最多发布一次，
+        间隔内只保留最新一条，在下次flush时补发；事件数据应为累计值"""
+        now = time.time()
+        if now - self._last_emit.get(event, 0) >= self.manager.update_interval:
+            self._last_emit[event] = now
+            self._held_events.pop(event, None)
+            self.emit(event, data)
+        else:
+            self._held_events[event] = data
+
+    def flush(self):
+        """将当前进度写入数据库并发布进度事件"""
+        self._last_flush = time.time()
+        try:
+            # 任务自身持有写事务时（如数据导入）数据库被锁定，跳过本次写入，结束时会写入最终状态
+            self.manager.update_job(self.job_id, timeout=0.1, total=self.total, done=self.done, failed=self.failed,
+                                    failures=json.dumps(list(self.failures), ensure_ascii=False))
+        except sqlite3.OperationalError:
+            pass
+        held_events, self._held_events = self._held_events, {}
+        for event, data in held_events.items():
+            self._last_emit[event] = self._last_flush
+            self.emit(event, data)
+        self.emit('progress', {'done': self.done, 'total': self.total, 'failed': self.failed})
+
+class BatchJobManager:
+    """后台批量任务管理：任务在后台线程执行，状态保存在SQLite中，页面刷新后可重新获取进度"""
+
+    def __init__(self, db_path='system.db', update_interval=0.5):
+        self.db_path = db_path
+        self.update_interval = update_interval  # 进度写入数据库的最小间隔（秒）
+        self._cancel_events = {}
+        self._event_logs = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, timeout=5):
+        return sqlite3.connect(self.db_path, timeout=timeout)
+
+    def create_job(self, job_type, params, created_by=None):
+        """创建任务，返回任务ID"""
+        job_id = uuid.uuid4().hex
+        conn = self._connect()
+        try:
+            conn.execute('''
+                INSERT INTO batch_jobs (id, job_type, status, params, created_by, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (job_id, job_type, JOB_PENDING, json.dumps(params, ensure_ascii=False),
+                  created_by, datetime.now().strftime(TIME_FORMAT)))
+            conn.commit()
+        finally:
+            conn.close()
+        return job_id
+
+    def update_job(self, job_id, timeout=5, **fields):
+        """更新任务字段"""
+        if not fields:
+            return
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        conn = self._connect(timeout)
+        try:
+            conn.execute(f'UPDATE batch_jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def start(self, job_id, target):
+        """在后台线程中执行任务，target(progress)返回结果字典（可包含download_url、message）"""
+        with self._lock:
+            self._cancel_events[job_id] = threading.Event()
+            self._event_logs[job_id] = JobEventLog()
+
+        def run():
+            progress = JobProgress(self, job_id)
+            self.update_job(job_id, status=JOB_RUNNING, started_at=datetime.now().strftime(TIME_FORMAT))
+            try:
+                result = target(progress)
+                status = JOB_COMPLETED if result.get('success', True) else JOB_FAILED
+                message = result.get('message')
+            except JobCancelled:
+                result = None
+                status = JOB_CANCELLED
+                message = '任务已取消'
+            except Exception as e:
+                result = None
+                status = JOB_FAILED
+                message = f'任务执行失败: {e}'
+            finally:
+                with self._lock:
+                    self._cancel_events.pop(job_id, None)
+
+            self.update_job(
+                job_id,
+                status=status,
+                total=progress.total,
+                done=progress.done,
+                failed=progress.failed,
+                failures=json.dumps(list(progress.failures), ensure_ascii=False),
+                result=json.dumps(result, ensure_ascii=False) if result is not None else None,
+                download_url=result.get('download_url') if result else None,
+                message=message,
+                finished_at=datetime.now().strftime(TIME_FORMAT)
+            )
+
+            # 发布结束事件后关闭事件记录，之后的订阅直接读取数据库中的最终状态
+            with self._lock:
+                event_log = self._event_logs.pop(job_id, None)
+            if event_log:
+                event_log.publish('finished', self.get_job(job_id))
+                event_log.close()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def publish(self, job_id, event, data):
+        """发布任务进度事件"""
+        with self._lock:
+            event_log = self._event_logs.get(job_id)
+        if event_log:
+            event_log.publish(event, data)
+
+    def stream_events(self, job_id, last_event_id=0, keepalive=15):
+        """按顺序读取任务进度事件，返回(事件序号, 事件类型, 数据)；空闲超过keepalive秒时返回None用于保持连接
+
+        断线重连时需要的事件已被淘汰的，先返回一条snapshot事件（数据库中的任务状态），再从保留的最早事件继续
+        """
+        with self._lock:
+            event_log = self._event_logs.get(job_id)
+        if event_log is None:
+            # 任务已结束（或不在本进程中运行），直接返回最终状态
+            yield (None, 'finished', self.get_job(job_id))
+            return
+
+        position = last_event_id
+        while True:
+            with event_log.condition:
+                if position >= event_log.last_id and not event_log.closed:
+                    event_log.condition.wait(keepalive)
+                first_id = event_log.first_id
+                skipped = position < first_id - 1
+                if skipped:
+                    position = first_id - 1
+                pending = [item for item in event_log.events if item[0] > position]
+                closed = event_log.closed
+            if skipped:
+                yield (position, 'snapshot', self.get_job(job_id))
+            if not pending and not closed:
+                if not skipped:
+                    yield None
+                continue
+            for item in pending:
+                yield item
+            position = pending[-1][0] if pending else position
+            if closed and position >= event_log.last_id:
+                return
+
+    def is_cancel_requested(self, job_id):
+        with self._lock:
+            event = self._cancel_events.get(job_id)
+        return event is not None and event.is_set()
+
+    def cancel(self, job_id):
+        """请求取消任务，返回是否为运行中的任务"""
+        with self._lock:
+            event = self._cancel_events.get(job_id)
+        if event is None:
+            return False
+        event.set()
+        return True
+
+    def get_job(self, job_id):
+        """获取任务状态，不存在时返回None"""
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        try:
+            row = conn.execute('SELECT * FROM batch_jobs WHERE id = ?', (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return self._row_to_job(row) if row else None
+
+    def get_active_jobs(self, job_type, created_by=None):
+        """获取未结束的任务（用于页面刷新后重新关联）"""
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        try:
+            query = f'''
+                SELECT * FROM batch_jobs
+                WHERE job_type = ? AND status IN ({', '.join('?' * len(ACTIVE_STATUSES))})
+            '''
+            params = [job_type, *ACTIVE_STATUSES]
+            if created_by is not None:
+                query += ' AND created_by = ?'
+                params.append(created_by)
+            rows = conn.execute(query + ' ORDER BY created_at DESC', params).fetchall()
+        finally:
+            conn.close()
+        return [self._row_to_job(row) for row in rows]
+
+    def mark_interrupted(self):
+        """系统重启后，将上次未结束的任务标记为失败"""
+        conn = self._connect()
+        try:
+            conn.execute(f'''
+                UPDATE batch_jobs SET status = ?, message = ?, finished_at = ?
+                WHERE status IN ({', '.join('?' * len(ACTIVE_STATUSES))})
+            ''', (JOB_FAILED, '系统重启，任务已中断', datetime.now().strftime(TIME_FORMAT), *ACTIVE_STATUSES))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _row_to_job(self, row):
+        job = dict(row)
+        job['params'] = json.loads(job['params']) if job['params'] else {}
+        job['failures'] = json.loads(job['failures']) if job['failures'] else []
+        job['failed'] = job.get('failed') or 0
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        job['cancel_requested'] = self.is_cancel_requested(job['id'])
+
+        # 耗时（秒）：已结束的任务按结束时间计算，运行中的任务按当前时间计算
+        elapsed = None
+        if job['started_at']:
+            started_at = datetime.strptime(job['started_at'], TIME_FORMAT)
+            finished_at = datetime.strptime(job['finished_at'], TIME_FORMAT) if job['finished_at'] else datetime.now()
+            elapsed = max(0, int((finished_at - started_at).total_seconds()))
+        job['elapsed'] = elapsed
+        return job
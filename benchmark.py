@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+性能基准测试脚本
+用法: python benchmark.py <测试项>
+"""
+
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+from docx import Document
+
+from render_engine import number_to_chinese_currency, replace_template_variables, RenderContext, render_job
+from render_scheduler import schedule_longest_first
+from batch_archive import ArchiveWriter, archive_options
+from compatibility import VariableMatcher, get_project_variables, normalize_variable_name
+
+def legacy_replace_template_variables(text, project_data):
+    """旧版实现：逐个变量检查并替换（用于对比）"""
+    if not text or not isinstance(text, str):
+        return text
+
+    fixed_column_mapping = {
+        '项目名称': '填报项目名称',
+        '系统项目名称': '填报项目名称'
+    }
+
+    result_text = text
+    for template_var, actual_var in fixed_column_mapping.items():
+        if f'{{{{{template_var}}}}}' in result_text and actual_var in project_data:
+            result_text = result_text.replace(f'{{{{{template_var}}}}}', str(project_data[actual_var]))
+
+    for var_name, var_value in project_data.items():
+        if f'{{{{{var_name}}}}}' in result_text:
+            if '大写' in var_name:
+                result_text = result_text.replace(f'{{{{{var_name}}}}}', number_to_chinese_currency(var_value))
+            else:
+                result_text = result_text.replace(f'{{{{{var_name}}}}}', str(var_value))
+
+    return result_text
+
+def legacy_find_matching_variable(template_var, project_vars):
+    """旧版实现：逐个项目变量做正则标准化和包含关系比较（用于对比）"""
+    def normalize(name):
+        if not name:
+            return ''
+        return re.sub(r'[\s\-_\(\)（）【】\[\]]+', '', name.strip())
+
+    template_var_normalized = normalize(template_var)
+    fixed_column_mapping = {
+        '项目名称': '填报项目名称',
+        '系统项目名称': '填报项目名称'
+    }
+    if template_var in fixed_column_mapping:
+        mapped_var = fixed_column_mapping[template_var]
+        if mapped_var in project_vars:
+            return mapped_var
+    if template_var in project_vars:
+        return template_var
+    for project_var in project_vars:
+        if normalize(project_var) == template_var_normalized:
+            return project_var
+    for project_var in project_vars:
+        project_var_normalized = normalize(project_var)
+        if (template_var_normalized in project_var_normalized or
+            project_var_normalized in template_var_normalized):
+            return project_var
+    return None
+
+def time_call(func, repeat=3):
+    """多次执行取最短耗时（秒）"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def benchmark_substitution():
+    """单元格文本替换：变量数量对耗时的影响"""
+    cell_count = 5000
+    print(f"单元格文本替换（{cell_count} 个单元格，每个单元格含2个变量）")
+    print(f"{'变量数':>8} {'旧实现(ms)':>12} {'新实现(ms)':>12} {'加速比':>8} {'渲染上下文(ms)':>14} {'加速比':>8}")
+
+    for var_count in [10, 50, 100, 300, 1000]:
+        project_data = {f'变量{i}': f'值{i}' for i in range(var_count)}
+        project_data['填报项目名称'] = '示例项目'
+        project_data['合同金额大写'] = '12345.67'
+        cells = [f'{{{{变量{i % var_count}}}}} 与 {{{{合同金额大写}}}}' for i in range(cell_count)]
+
+        render_context = RenderContext(project_data)
+
+        # 各实现结果必须一致
+        for cell in cells[:100]:
+            expected = legacy_replace_template_variables(cell, project_data)
+            assert replace_template_variables(cell, project_data) == expected
+            assert replace_template_variables(cell, render_context) == expected
+
+        legacy = time_call(lambda: [legacy_replace_template_variables(c, project_data) for c in cells])
+        current = time_call(lambda: [replace_template_variables(c, project_data) for c in cells])
+        def replace_with_context():
+            # 渲染上下文的构建计入耗时（每个项目构建一次）
+            context = RenderContext(project_data)
+            return [replace_template_variables(c, context) for c in cells]
+
+        with_context = time_call(replace_with_context)
+        print(f"{var_count:>8} {legacy * 1000:>12.1f} {current * 1000:>12.1f} {legacy / current:>7.1f}x"
+              f" {with_context * 1000:>14.1f} {legacy / with_context:>7.1f}x")
+
+def benchmark_archive():
+    """批量压缩包：全部重新压缩 与 已压缩格式直接存储/并行压缩 的对比"""
+    doc = Document()
+    for i in range(2000):
+        doc.add_paragraph(f'第{i}段 合同金额：{i * 100} 元，甲方：示例单位{i % 50}')
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    data = buffer.getvalue()
+    entries = [(f'P{i:03d}/合同/合同.docx', data) for i in range(200)]
+    print(f"批量压缩包（{len(entries)} 个Word文件，每个 {len(data) / 1024:.0f} KB）")
+    print(f"{'方式':<28} {'耗时(ms)':>10} {'大小(MB)':>10}")
+
+    def deflate_all():
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for arcname, content in entries:
+                zf.writestr(arcname, content)
+        return output
+
+    def archive_writer(threads):
+        output = io.BytesIO()
+        writer = ArchiveWriter(output, threads=threads)
+        for arcname, content in entries:
+            writer.add(arcname, content)
+        writer.close()
+        return output
+
+    store_extensions = archive_options['store_extensions']
+    cases = [
+        ('ZIP_DEFLATED（旧实现）', deflate_all, store_extensions),
+        ('直接存储', lambda: archive_writer(1), store_extensions),
+        ('全部压缩，单线程', lambda: archive_writer(1), set()),
+        ('全部压缩，4线程', lambda: archive_writer(4), set()),
+    ]
+    for name, func, extensions in cases:
+        archive_options['store_extensions'] = extensions
+        try:
+            output = func()
+            elapsed = time_call(func)
+        finally:
+            archive_options['store_extensions'] = store_extensions
+        assert zipfile.ZipFile(output).testzip() is None
+        print(f"{name:<28} {elapsed * 1000:>10.1f} {len(output.getvalue()) / 1024 / 1024:>10.2f}")
+
+# 批量生成内存上限（MB）：内存占用应与批量大小无关，超过时测试失败
+BATCH_MEMORY_CEILING_MB = 64
+
+class MockRenderPool:
+    """模拟渲染执行器：不读取模板，直接返回固定内容（每97个文件失败一个），只测试批量生成流程本身的内存占用"""
+
+    workers = 1
+
+    def __init__(self, file_size=256):
+        self.data = b'x' * file_size
+
+    def run(self, jobs):
+        for index, job in enumerate(jobs):
+            result = {'project_id': job['project_id'], 'template_id': job['template_id'],
+                      'arcname': job['arcname'], 'render_seconds': 0.001}
+            if (job['project_id'] + index) % 97 == 0:
+                result.update(success=False, error='模拟渲染失败')
+            else:
+                result.update(success=True, data=self.data)
+            yield result
+
+def benchmark_batch_memory():
+    """完整的批量生成后台任务（分块读取、渲染、写入压缩包、进度事件）在不同项目数下的内存峰值，渲染由MockRenderPool模拟
+
+    内存峰值超过BATCH_MEMORY_CEILING_MB时返回False
+    """
+    import app
+    from batch_jobs import ACTIVE_STATUSES, BatchJobManager
+    from render_scheduler import RenderStats
+
+    variable_count = 20
+    missing_every = 100  # 每100个项目ID中有一个不存在
+    print(f"批量生成内存峰值（每个项目 {variable_count} 个变量、2 个模板，渲染使用模拟结果，"
+          f"上限 {BATCH_MEMORY_CEILING_MB} MB）")
+    print(f"{'项目数':>8} {'耗时(s)':>8} {'内存峰值(MB)':>12} {'压缩包条目':>10} {'失败项目':>8} "
+          f"{'保留失败':>8} {'保留事件':>8}")
+
+    passed = True
+    with tempfile.TemporaryDirectory() as temp_dir:
+        original = (app.app_path, app.app.config['OUTPUT_FOLDER'], app.render_pool, app.output_cache.enabled,
+                    app.render_stats, app.batch_job_manager)
+        app.app_path = temp_dir
+        app.app.config['OUTPUT_FOLDER'] = os.path.join(temp_dir, 'output')
+        app.render_pool = MockRenderPool()
+        app.output_cache.enabled = False
+        app.render_stats = RenderStats(os.path.join(temp_dir, 'system.db'))
+        manager = app.batch_job_manager = BatchJobManager(os.path.join(temp_dir, 'system.db'))
+        try:
+            app.init_db()
+            conn = app.get_db_connection()
+            conn.executemany('INSERT INTO templates (name, filename, file_path, file_type) VALUES (?, ?, ?, ?)',
+                             [('合同', 'a.docx', 'a.docx', '.docx'), ('预算', 'b.xlsx', 'b.xlsx', '.xlsx')])
+            project_count = 0
+            for total in [10000, 100000]:
+                new_ids = [i for i in range(project_count + 1, total + 1) if i % missing_every]
+                conn.executemany('INSERT INTO projects (id, name, contract_number) VALUES (?, ?, ?)',
+                                 ((i, f'项目{i}', f'HT{i}') for i in new_ids))
+                conn.executemany('INSERT INTO project_data (project_id, variable_name, variable_value) VALUES (?, ?, ?)',
+                                 ((i, f'变量{k}', f'项目{i}的值{k}') for i in new_ids for k in range(variable_count)))
+                conn.commit()
+                project_count = total
+                project_ids = list(range(1, total + 1))
+
+                job_id = manager.create_job('batch_generate', {})
+                tracemalloc.start()
+                start = time.perf_counter()
+                manager.start(job_id, lambda progress: app.run_batch_generation(project_ids, progress, keep_files=False))
+                event_log = manager._event_logs[job_id]
+                job = manager.get_job(job_id)
+                while job['status'] in ACTIVE_STATUSES:
+                    time.sleep(0.2)
+                    job = manager.get_job(job_id)
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+                tracemalloc.stop()
+
+                result = job['result'] or {}
+                if not result.get('download_url'):
+                    print(f"❌ 批量生成失败: {job['message']}")
+                    return False
+                zip_path = os.path.join(app.app.config['OUTPUT_FOLDER'], os.path.basename(result['download_url']))
+                with zipfile.ZipFile(zip_path) as zf:
+                    entry_count = len(zf.infolist())
+                os.remove(zip_path)
+                assert entry_count == result['generated_files_count']
+                print(f"{total:>8} {elapsed:>8.1f} {peak:>12.1f} {entry_count:>10} {result['fail_count']:>8} "
+                      f"{len(result['failures']):>8} {len(event_log.events):>8}")
+                if peak > BATCH_MEMORY_CEILING_MB:
+                    print(f"❌ 内存峰值 {peak:.1f} MB 超过上限 {BATCH_MEMORY_CEILING_MB} MB")
+                    passed = False
+            conn.close()
+        finally:
+            (app.app_path, app.app.config['OUTPUT_FOLDER'], app.render_pool, app.output_cache.enabled,
+             app.render_stats, app.batch_job_manager) = original
+    return passed
+
+def benchmark_matching():
+    """项目可用模板列表的变量匹配：逐个比较 与 变量匹配索引 的对比（每次请求重新构建索引）"""
+    random.seed(0)
+    template_count = 30
+    variables_per_template = 20
+    words = ['合同', '金额', '甲方', '乙方', '单位', '名称', '日期', '地址', '电话', '账号', '开户行', '负责人', '数量', '单价']
+    print(f"项目可用模板列表变量匹配（{template_count} 个模板，每个模板 {variables_per_template} 个变量）")
+    print(f"{'项目变量数':>10} {'旧实现(ms)':>12} {'匹配索引(ms)':>14} {'加速比':>8}")
+
+    for variable_count in [50, 100, 400, 1000]:
+        project_vars = get_project_variables(
+            {f'{random.choice(words)}{random.choice(words)}{i}' for i in range(variable_count)}, '示例项目', 'HT-001')
+        names = sorted(project_vars)
+        templates = []
+        for _ in range(template_count):
+            required = set()
+            for _ in range(variables_per_template):
+                name = random.choice(names)
+                # 精确、带标点/空格、部分名称、不存在的变量
+                required.add(random.choice([
+                    name, f'{name[:2]}（{name[2:]}）', f' {name} ', name[2:], name[:3], f'{name}备注', f'未知变量{random.randint(0, 999)}'
+                ]))
+            required.update(['项目名称', '备注说明'])
+            templates.append(required)
+
+        # 匹配结果必须一致
+        matcher = VariableMatcher(project_vars)
+        for required in templates:
+            for template_var in required:
+                assert matcher.find(template_var) == legacy_find_matching_variable(template_var, project_vars)
+
+        def legacy():
+            return [[legacy_find_matching_variable(v, project_vars) for v in required] for required in templates]
+
+        def indexed():
+            normalize_variable_name.cache_clear()
+            matcher = VariableMatcher(project_vars)
+            return [[matcher.find(v) for v in required] for required in templates]
+
+        legacy_time = time_call(legacy)
+        indexed_time = time_call(indexed)
+        print(f"{len(project_vars):>10} {legacy_time * 1000:>12.1f} {indexed_time * 1000:>14.2f} {legacy_time / indexed_time:>7.1f}x")
+
+def simulate_makespan(jobs, seconds, workers):
+    """按提交顺序把任务分给最先空闲的工作进程（与进程池取任务的方式相同），返回全部完成的时间"""
+    finish_times = [0.0] * workers
+    for job in jobs:
+        index = finish_times.index(min(finish_times))
+        finish_times[index] += seconds[job['template_id']]
+    return max(finish_times)
+
+def benchmark_scheduling():
+    """并行批量生成的任务顺序：按项目顺序 与 按估算耗时从长到短 的总耗时对比
+
+    先实际渲染测得各模板耗时，再按进程池的取任务方式模拟多个工作进程的总耗时（与本机CPU核数无关）
+    """
+    project_count = 6
+    # (模板ID, 段落数, 表格行数)：5个一页的回执/通知，最后一个是带表格的长合同
+    template_specs = [(1, 5, 0), (2, 10, 0), (3, 20, 0), (4, 40, 0), (5, 60, 0), (6, 2000, 400)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        template_paths = {}
+        for template_id, paragraph_count, row_count in template_specs:
+            doc = Document()
+            for i in range(paragraph_count):
+                doc.add_paragraph(f'第{i}条 合同金额：{{{{合同金额}}}} 元，甲方：{{{{甲方}}}}')
+            if row_count:
+                table = doc.add_table(rows=row_count, cols=3)
+                for row in table.rows:
+                    row.cells[0].text = '{{甲方}}'
+                    row.cells[1].text = '{{合同金额}}'
+            template_paths[template_id] = os.path.join(temp_dir, f'T{template_id}.docx')
+            doc.save(template_paths[template_id])
+
+        # 与批量生成相同，按项目、模板ID顺序生成任务
+        jobs = [{
+            'project_id': project_id, 'template_id': template_id, 'template_path': template_paths[template_id],
+            'file_type': '.docx', 'project_data': RenderContext({'合同金额': str(project_id), '甲方': f'单位{project_id}'}),
+            'output_path': None, 'return_data': True, 'render_plan': None
+        } for project_id in range(project_count) for template_id in template_paths]
+
+        # 实测各模板的渲染耗时（即统计表中记录的耗时）
+        seconds = {}
+        for template_id in template_paths:
+            job = next(job for job in jobs if job['template_id'] == template_id)
+            seconds[template_id] = min(render_job(job)['render_seconds'] for _ in range(3))
+        print(f"{project_count} 个项目 × {len(template_paths)} 个模板，各模板渲染耗时(s): "
+              + ', '.join(f'T{template_id}={value:.3f}' for template_id, value in seconds.items()))
+
+        # 没有历史耗时时只按模板结构估算，有历史耗时时使用实测值
+        structural_order = schedule_longest_first(jobs, {})
+        measured_order = schedule_longest_first(jobs, seconds)
+        total = sum(seconds[job['template_id']] for job in jobs)
+        print(f"{'工作进程':>8} {'项目顺序(s)':>12} {'结构估算(s)':>12} {'历史耗时(s)':>12} {'下限(s)':>8}")
+        for workers in [2, 4, 8]:
+            lower_bound = max(total / workers, max(seconds.values()))
+            print(f"{workers:>8} {simulate_makespan(jobs, seconds, workers):>12.2f} "
+                  f"{simulate_makespan(structural_order, seconds, workers):>12.2f} "
+                  f"{simulate_makespan(measured_order, seconds, workers):>12.2f} {lower_bound:>8.2f}")
+
+# 可用的基准测试项
+BENCHMARKS = {
+    'substitution': benchmark_substitution,
+    'archive': benchmark_archive,
+    'batch_memory': benchmark_batch_memory,
+    'matching': benchmark_matching,
+    'scheduling': benchmark_scheduling,
+}
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"❌ 未知的测试项: {name}，可选: {', '.join(BENCHMARKS)}")
+            return 1
+        if BENCHMARKS[name]() is False:
+            return 1
+        print()
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,314 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+from render_engine import FIXED_COLUMN_MAPPING
+
+# 项目基本信息对应的变量（不保存在项目数据中）
+PROJECT_NAME_VARIABLE = '填报项目名称'
+CONTRACT_NUMBER_VARIABLE = '备注说明'
+
+# 标准化变量名时去除的空格和常见标点符号
+_VARIABLE_NAME_NOISE = re.compile(r'[\s\-_\(\)（）【】\[\]]+')
+
+# ==================== 模板变量匹配 ====================
+
+@lru_cache(maxsize=65536)
+def normalize_variable_name(name):
+    """标准化变量名，去除空格和常见标点符号（结果缓存，同一变量名只做一次正则替换）"""
+    if not name:
+        return ''
+    return _VARIABLE_NAME_NOISE.sub('', name.strip())
+
+def _name_grams(normalized):
+    """变量名中的单字和相邻两字，用于包含关系匹配的候选查找"""
+    return set(normalized) | {normalized[i:i + 2] for i in range(len(normalized) - 1)}
+
+class VariableMatcher:
+    """项目变量的匹配索引：精确匹配和标准化匹配查哈希表，包含关系匹配先按单字/两字索引找候选再验证
+
+    每个项目构建一次，所有模板变量共用；匹配规则和结果与逐个比较项目变量时完全相同
+    （多个项目变量都能匹配时，返回项目变量集合迭代顺序中的第一个）
+    """
+
+    def __init__(self, project_vars):
+        self.variables = list(project_vars)
+        self._present = set(self.variables)
+        self._normalized_names = [normalize_variable_name(name) for name in self.variables]
+        self._positions = {}  # 标准化变量名 -> 位置列表（升序）
+        self._grams = {}  # 单字/两字 -> 包含它的变量位置
+        for position, normalized in enumerate(self._normalized_names):
+            self._positions.setdefault(normalized, []).append(position)
+            for gram in _name_grams(normalized):
+                self._grams.setdefault(gram, set()).add(position)
+        self._lengths = sorted({len(normalized) for normalized in self._positions})
+
+    def _containing(self, normalized):
+        """标准化名包含normalized的变量位置"""
+        if not normalized:
+            return set(range(len(self.variables)))
+        if len(normalized) == 1:
+            return set(self._grams.get(normalized, ()))
+        candidate_sets = [self._grams.get(normalized[i:i + 2]) for i in range(len(normalized) - 1)]
+        if not all(candidate_sets):
+            return set()
+        candidate_sets.sort(key=len)
+        return {position for position in candidate_sets[0].intersection(*candidate_sets[1:])
+                if normalized in self._normalized_names[position]}
+
+    def _contained(self, normalized):
+        """标准化名是normalized的子串的变量位置"""
+        positions = set()
+        for length in self._lengths:
+            if length > len(normalized):
+                break
+            for start in range(len(normalized) - length + 1):
+                positions.update(self._positions.get(normalized[start:start + length], ()))
+        return positions
+
+    def find(self, template_var):
+        """查找匹配的项目变量，没有匹配时返回None"""
+        # 首先检查固定列名映射（合同编号相关变量不映射，备注说明来自项目基本信息）
+        mapped_var = FIXED_COLUMN_MAPPING.get(template_var)
+        if mapped_var is not None and mapped_var in self._present:
+            return mapped_var
+
+        # 然后尝试精确匹配
+        if template_var in self._present:
+            return template_var
+
+        # 然后尝试标准化后的匹配
+        template_var_normalized = normalize_variable_name(template_var)
+        positions = self._positions.get(template_var_normalized)
+        if positions:
+            return self.variables[positions[0]]
+
+        # 最后尝试包含关系匹配
+        positions = self._containing(template_var_normalized) | self._contained(template_var_normalized)
+        return self.variables[min(positions)] if positions else None
+
+    def find_all(self, template_var):
+        """能满足模板变量的全部项目变量（任一条匹配规则成立）"""
+        template_var_normalized = normalize_variable_name(template_var)
+        positions = self._containing(template_var_normalized) | self._contained(template_var_normalized)
+        matches = {self.variables[position] for position in positions}
+        for name in (FIXED_COLUMN_MAPPING.get(template_var), template_var):
+            if name is not None and name in self._present:
+                matches.add(name)
+        return matches
+
+def find_matching_variable(template_var, project_vars):
+    """查找匹配的项目变量（需要匹配多个模板变量时应构建一次VariableMatcher共用）"""
+    return VariableMatcher(project_vars).find(template_var)
+
+def get_project_variables(data_variables, project_name, contract_number):
+    """项目已有的变量：项目数据中的变量，加上有值的基本信息（填报项目名称、备注说明）"""
+    project_variables = set(data_variables)
+    if project_name:  # 项目名称
+        project_variables.add(PROJECT_NAME_VARIABLE)
+    if contract_number:  # 合同编号
+        project_variables.add(CONTRACT_NUMBER_VARIABLE)
+    return project_variables
+
+def match_template_variables(required_vars, project_variables):
+    """按项目变量匹配模板需要的变量，返回(已匹配的变量, 缺少的变量)；project_variables可以是已构建的VariableMatcher"""
+    if not isinstance(project_variables, VariableMatcher):
+        project_variables = VariableMatcher(project_variables)
+    missing_vars = set()
+    matched_vars = set()
+    for required_var in required_vars:
+        if project_variables.find(required_var):
+            matched_vars.add(required_var)
+        else:
+            missing_vars.add(required_var)
+    return matched_vars, missing_vars
+
+class ReadinessCache:
+    """项目可用模板列表的响应缓存：按(项目版本, 模板版本)缓存，按LRU淘汰
+
+    写入项目数据时递增该项目的版本，上传/删除模板和重命名变量时递增模板版本，旧版本的缓存不再命中；
+    响应内容的摘要作为ETag，浏览器可以用If-None-Match重新验证
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._project_versions = {}
+        self._templates_version = 0
+        self._entries = OrderedDict()  # 项目ID -> (版本, ETag, 响应内容)
+        self._lock = threading.Lock()
+
+    def version(self, project_id):
+        """项目当前的缓存版本；应在读取数据之前获取，读取期间发生写入时缓存的结果会因版本过期而不再命中"""
+        with self._lock:
+            return (self._project_versions.get(project_id, 0), self._templates_version)
+
+    def get(self, project_id):
+        """返回(ETag, 响应内容)，未命中或版本已过期时返回None"""
+        with self._lock:
+            entry = self._entries.get(project_id)
+            current = (self._project_versions.get(project_id, 0), self._templates_version)
+            if entry and entry[0] == current:
+                self._entries.move_to_end(project_id)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, project_id, version, body):
+        """保存响应内容（version为读取数据前获取的版本），返回ETag"""
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        with self._lock:
+            self._entries[project_id] = (version, etag, body)
+            self._entries.move_to_end(project_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return etag
+
+    def bump_projects(self, project_ids):
+        """项目数据或基本信息已修改"""
+        with self._lock:
+            for project_id in project_ids:
+                self._project_versions[project_id] = self._project_versions.get(project_id, 0) + 1
+                self._entries.pop(project_id, None)
+
+    @property
+    def templates_version(self):
+        return self._templates_version
+
+    def bump_templates(self):
+        """模板或模板变量已修改，所有项目的缓存失效"""
+        with self._lock:
+            self._templates_version += 1
+            self._entries.clear()
+
+def changed_variables(old_data, new_data):
+    """项目数据修改前后值不同（包括新增和删除）的变量名"""
+    return {name for name in set(old_data) | set(new_data)
+            if str(old_data.get(name, '')) != str(new_data.get(name, ''))}
+
+class TemplateDependencyIndex:
+    """变量 → 模板的依赖索引（来自template_variables）：项目数据变化后只需重新生成引用了变化变量的模板
+
+    version为构建时的模板版本，模板或变量名变化后应重新构建
+    """
+
+    def __init__(self, rows, version=None):
+        self.version = version
+        self._templates = {}  # 项目数据中的变量名 -> 引用它的模板ID集合
+        for template_id, variable_name in rows:
+            self._templates.setdefault(variable_name, set()).add(template_id)
+            # 固定列名映射的变量（如项目名称）渲染时使用映射后变量的值
+            mapped_var = FIXED_COLUMN_MAPPING.get(variable_name)
+            if mapped_var:
+                self._templates.setdefault(mapped_var, set()).add(template_id)
+
+    def templates_for(self, variable_names):
+        """引用了任一变量的模板ID"""
+        template_ids = set()
+        for name in variable_names:
+            template_ids.update(self._templates.get(name, ()))
+        return template_ids
+
+# ==================== 项目 × 模板兼容性矩阵 ====================
+
+def _to_bitsets(id_sets, bit_count):
+    """将整数ID集合列表转换为位集矩阵（每行一个集合，按64位分组）"""
+    word_count = max(1, (bit_count + 63) // 64)
+    bitsets = np.zeros((len(id_sets), word_count), dtype=np.uint64)
+    rows = [row for row, ids in enumerate(id_sets) for _ in ids]
+    if rows:
+        ids = np.fromiter((i for ids in id_sets for i in ids), dtype=np.int64, count=len(rows))
+        bits = np.left_shift(np.uint64(1), (ids % 64).astype(np.uint64))
+        np.bitwise_or.at(bitsets, (np.array(rows), ids // 64), bits)
+    return bitsets
+
+def _intersects(left, right, chunk_size=256):
+    """逐行判断两组位集是否有交集，返回(左侧行数 × 右侧行数)的布尔矩阵；按块计算以限制内存"""
+    result = np.zeros((left.shape[0], right.shape[0]), dtype=bool)
+    for start in range(0, left.shape[0], chunk_size):
+        block = left[start:start + chunk_size]
+        result[start:start + chunk_size] = ((block[:, None, :] & right[None, :, :]) != 0).any(axis=2)
+    return result
+
+class CompatibilityMatrix:
+    """项目 × 模板兼容性矩阵：变量名映射为整数ID，项目已有变量和模板需要的变量表示为位集，一次向量化计算全部组合
+
+    projects为[(项目ID, 项目数据中的变量名, 项目名称, 合同编号)]，templates为[(模板ID, 需要的变量名)]；
+    缺少变量数与get_templates_for_project的匹配规则一致，related表示项目数据与模板有同名变量（用于关联统计）
+    """
+
+    def __init__(self, projects, templates):
+        self.project_ids = [project[0] for project in projects]
+        self.template_ids = [template[0] for template in templates]
+
+        # 项目变量名 -> 整数ID
+        variable_ids = {}
+        def intern(name):
+            return variable_ids.setdefault(name, len(variable_ids))
+
+        data_sets = [{intern(name) for name in project[1]} for project in projects]
+        present_sets = [
+            ids | {intern(name) for name in get_project_variables((), project[2], project[3])}
+            for ids, project in zip(data_sets, projects)
+        ]
+
+        # 模板变量名 -> 整数ID，以及能满足它的项目变量位集
+        template_variable_ids = {}
+        for template in templates:
+            for name in template[1]:
+                template_variable_ids.setdefault(name, len(template_variable_ids))
+        matcher = VariableMatcher(variable_ids)
+        satisfier_sets = [
+            {variable_ids[variable_name] for variable_name in matcher.find_all(template_var)}
+            for template_var in template_variable_ids
+        ]
+
+        bit_count = len(variable_ids)
+        data_bits = _to_bitsets(data_sets, bit_count)
+        present_bits = _to_bitsets(present_sets, bit_count)
+        satisfier_bits = _to_bitsets(satisfier_sets, bit_count)
+        template_bits = _to_bitsets(
+            [{variable_ids[name] for name in template[1] if name in variable_ids} for template in templates], bit_count)
+
+        # 模板 × 模板变量的包含关系
+        requires = np.zeros((len(templates), len(template_variable_ids)), dtype=np.int32)
+        for row, template in enumerate(templates):
+            for name in template[1]:
+                requires[row, template_variable_ids[name]] = 1
+
+        # 项目 × 模板变量：是否有满足该变量的项目变量；缺少变量数 = 未满足的模板变量计数
+        satisfied = _intersects(present_bits, satisfier_bits)
+        self.missing_counts = (~satisfied).astype(np.int32) @ requires.T
+        self.can_generate = self.missing_counts == 0
+        self.related = _intersects(data_bits, template_bits)
+
+    def project_related_counts(self):
+        """每个项目关联的模板数 {项目ID: 数量}"""
+        return dict(zip(self.project_ids, self.related.sum(axis=1).tolist()))
+
+    def template_related_counts(self):
+        """每个模板关联的项目数 {模板ID: 数量}"""
+        return dict(zip(self.template_ids, self.related.sum(axis=0).tolist()))
+
+    def project_ready_counts(self):
+        """每个项目变量齐全、可以生成的模板数 {项目ID: 数量}"""
+        return dict(zip(self.project_ids, self.can_generate.sum(axis=1).tolist()))
+
+    def template_ready_counts(self):
+        """每个模板变量齐全的项目数 {模板ID: 数量}"""
+        return dict(zip(self.template_ids, self.can_generate.sum(axis=0).tolist()))
+
+    def to_dict(self):
+        return {
+            'project_ids': self.project_ids,
+            'template_ids': self.template_ids,
+            'missing_counts': self.missing_counts.tolist(),
+            'can_generate': self.can_generate.tolist(),
+            'related': self.related.tolist()
+        }
@@ -0,0 +1,273 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import uuid
+from datetime import datetime
+
+from render_engine import RENDERER_VERSION, content_digest, render_options
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def file_sha256(file_path):
+    """计算文件内容的SHA-256"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def compute_cache_key(template_hash, file_type, project_data):
+    """计算输出缓存键：模板内容哈希 + 渲染器版本（含渲染引擎）+ 规范化的项目数据
+
+    生成文件只取决于这三项，任一项变化都会得到新的缓存键
+    """
+    payload = json.dumps({
+        'template': template_hash,
+        'file_type': file_type,
+        'renderer': [RENDERER_VERSION, render_options['docx_engine'], render_options['xlsx_engine']],
+        'data': project_data
+    }, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class BlobStore:
+    """内容寻址存储：内容相同的生成文件只保存一份（按内容摘要前两位分目录），项目目录中的文件是指向它的硬链接
+
+    不支持硬链接的文件系统上退化为复制；没有任何硬链接和缓存引用的内容由collect_garbage删除
+    """
+
+    def __init__(self, root='output/.blobs'):
+        self.root = root
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def is_blob(self, path):
+        return os.path.normpath(path).startswith(os.path.normpath(self.root) + os.sep)
+
+    def put(self, data, digest=None):
+        """保存内容，返回内容文件路径（相同内容已存在时直接返回）；digest为已计算好的内容摘要"""
+        blob_path = self.blob_path(digest or content_digest(data))
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # 先写入临时文件再替换，避免读取到写了一半的内容
+            temp_path = f'{blob_path}.{uuid.uuid4().hex}.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, blob_path)
+        return blob_path
+
+    def link(self, blob_path, dest_path):
+        """在dest_path创建指向内容文件的硬链接（已存在的文件被替换）"""
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        temp_path = f'{dest_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            os.link(blob_path, temp_path)
+        except FileNotFoundError:
+            raise  # 内容文件不存在，由调用方处理
+        except OSError:
+            # 文件系统不支持硬链接，复制一份
+            shutil.copyfile(blob_path, temp_path)
+        os.replace(temp_path, dest_path)
+
+    def write(self, dest_path, data, digest=None):
+        """保存内容并在dest_path创建硬链接，返回内容文件路径"""
+        blob_path = self.put(data, digest)
+        try:
+            self.link(blob_path, dest_path)
+        except FileNotFoundError:
+            # 内容文件恰好被垃圾回收删除，重新写入
+            blob_path = self.put(data, digest)
+            self.link(blob_path, dest_path)
+        return blob_path
+
+    def release(self, blob_path):
+        """内容文件已没有硬链接时删除，返回释放的字节数"""
+        try:
+            stat = os.stat(blob_path)
+            if stat.st_nlink > 1:
+                return 0
+            os.remove(blob_path)
+            return stat.st_size
+        except OSError:
+            return 0
+
+    def collect_garbage(self, referenced=()):
+        """删除没有硬链接且不在referenced（缓存引用的内容文件路径）中的内容，返回(删除数量, 释放字节数)"""
+        referenced = {os.path.normpath(path) for path in referenced}
+        removed_count = 0
+        removed_size = 0
+        if not os.path.exists(self.root):
+            return removed_count, removed_size
+        for root, dirs, files in os.walk(self.root):
+            for file in files:
+                blob_path = os.path.normpath(os.path.join(root, file))
+                if blob_path in referenced:
+                    continue
+                freed = self.release(blob_path)
+                if freed or not os.path.exists(blob_path):
+                    removed_count += 1
+                    removed_size += freed
+        return removed_count, removed_size
+
+class OutputCache:
+    """生成文件缓存：相同模板和项目数据再次生成时直接复用已生成的文件
+
+    缓存内容保存在内容寻址存储中，索引保存在SQLite中，可按项目或模板失效
+    """
+
+    def __init__(self, db_path='system.db', blob_store=None, enabled=True):
+        self.db_path = db_path
+        self.blob_store = blob_store or BlobStore()
+        self.enabled = enabled
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def get_path(self, cache_key):
+        """返回缓存文件路径，未命中（或缓存文件已被清理）时返回None"""
+        if not self.enabled or not cache_key:
+            return None
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT file_path FROM output_cache WHERE cache_key = ?', (cache_key,)).fetchone()
+            if row is None:
+                return None
+            if os.path.exists(row[0]):
+                return row[0]
+            # 缓存文件已被删除（如清理导出文件），移除索引
+            conn.execute('DELETE FROM output_cache WHERE cache_key = ?', (cache_key,))
+            conn.commit()
+            return None
+        finally:
+            conn.close()
+
+    def get_paths(self, cache_keys):
+        """批量查询缓存，返回{缓存键: 缓存文件路径}，未命中的键不在结果中；一块任务只查询一次数据库"""
+        cache_keys = list({key for key in cache_keys if key})
+        if not self.enabled or not cache_keys:
+            return {}
+        conn = self._connect()
+        try:
+            paths = {}
+            for start in range(0, len(cache_keys), 500):
+                chunk = cache_keys[start:start + 500]
+                paths.update(conn.execute(
+                    f"SELECT cache_key, file_path FROM output_cache WHERE cache_key IN ({', '.join('?' * len(chunk))})",
+                    chunk
+                ))
+            # 缓存文件已被删除（如清理导出文件），移除索引
+            missing = [key for key, path in paths.items() if not os.path.exists(path)]
+            if missing:
+                for start in range(0, len(missing), 500):
+                    chunk = missing[start:start + 500]
+                    conn.execute(f"DELETE FROM output_cache WHERE cache_key IN ({', '.join('?' * len(chunk))})", chunk)
+                conn.commit()
+            return {key: path for key, path in paths.items() if key not in missing}
+        finally:
+            conn.close()
+
+    def read(self, cache_key):
+        """读取缓存文件内容，未命中时返回None"""
+        cache_path = self.get_path(cache_key)
+        if cache_path is None:
+            return None
+        try:
+            with open(cache_path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, cache_key, project_id, template_id, blob_path):
+        """记录生成结果，blob_path为内容寻址存储中的内容文件"""
+        if not self.enabled or not cache_key:
+            return
+        conn = self._connect()
+        try:
+            conn.execute('''
+                INSERT OR REPLACE INTO output_cache (cache_key, project_id, template_id, file_path, file_size, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (cache_key, project_id, template_id, blob_path, os.path.getsize(blob_path),
+                  datetime.now().strftime(TIME_FORMAT)))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def put_many(self, entries):
+        """在一个事务中记录多个生成结果，entries为(缓存键, 项目ID, 模板ID, 内容文件路径)列表"""
+        rows = [(cache_key, project_id, template_id, blob_path, os.path.getsize(blob_path))
+                for cache_key, project_id, template_id, blob_path in entries if cache_key]
+        if not self.enabled or not rows:
+            return
+        created_at = datetime.now().strftime(TIME_FORMAT)
+        conn = self._connect()
+        try:
+            conn.executemany('''
+                INSERT OR REPLACE INTO output_cache (cache_key, project_id, template_id, file_path, file_size, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [row + (created_at,) for row in rows])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def referenced_paths(self):
+        """缓存引用的全部内容文件路径"""
+        conn = self._connect()
+        try:
+            return [row[0] for row in conn.execute('SELECT DISTINCT file_path FROM output_cache')]
+        finally:
+            conn.close()
+
+    def invalidate(self, project_ids=None, template_ids=None):
+        """删除指定项目或模板的缓存，返回删除的缓存数"""
+        conditions = []
+        params = []
+        for column, ids in (('project_id', project_ids), ('template_id', template_ids)):
+            if ids:
+                ids = list(ids)
+                conditions.append(f"{column} IN ({', '.join('?' * len(ids))})")
+                params.extend(ids)
+        if not conditions:
+            return 0
+        where = ' OR '.join(conditions)
+
+        conn = self._connect()
+        try:
+            rows = conn.execute(f'SELECT file_path FROM output_cache WHERE {where}', params).fetchall()
+            conn.execute(f'DELETE FROM output_cache WHERE {where}', params)
+            conn.commit()
+            # 内容可能被其他缓存项共用
+            paths = {row[0] for row in rows}
+            still_referenced = {
+                row[0] for row in conn.execute(
+                    f"SELECT file_path FROM output_cache WHERE file_path IN ({', '.join('?' * len(paths))})", list(paths)
+                )
+            } if paths else set()
+        finally:
+            conn.close()
+        self._release_files(paths - still_referenced)
+        return len(rows)
+
+    def clear(self):
+        """删除全部缓存"""
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT file_path FROM output_cache').fetchall()
+            conn.execute('DELETE FROM output_cache')
+            conn.commit()
+        finally:
+            conn.close()
+        self._release_files({row[0] for row in rows})
+        return len(rows)
+
+    def _release_files(self, paths):
+        # 项目目录中仍有硬链接的内容保留，由项目文件继续使用
+        for path in paths:
+            if self.blob_store.is_blob(path):
+                self.blob_store.release(path)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -0,0 +1,986 @@
+import os
+import hashlib
+import re
+import io
+import copy
+import json
+import posixpath
+import struct
+import zipfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from docx import Document
+from docx.text.paragraph import Paragraph
+from openpyxl import load_workbook
+from lxml import etree
+
+# 模板变量格式：{{变量名}}
+VARIABLE_PATTERN = re.compile(r'\{\{([^}]+)\}\}')
+
+# 固定列名映射：模板变量名 -> 项目数据中的实际变量名
+# 注意：合同编号相关变量不在此处映射，应直接使用用户定义的变量名
+FIXED_COLUMN_MAPPING = {
+    '项目名称': '填报项目名称',
+    '系统项目名称': '填报项目名称'
+}
+
+# 渲染引擎配置（按部署选择）
+# docx_engine: python-docx（对象模型） | ooxml（直接改写XML部件）
+# xlsx_engine: openpyxl（对象模型） | ooxml（直接改写共享字符串表）
+render_options = {
+    'docx_engine': 'python-docx',
+    'xlsx_engine': 'openpyxl'
+}
+
+# 渲染器版本：替换规则或输出格式变化时递增，使已缓存的生成文件失效
+RENDERER_VERSION = 1
+
+# 数字转人民币大写函数
+def number_to_chinese_currency(num):
+    """将数字转换为人民币大写格式"""
+    try:
+        # 处理字符串输入，去除可能的货币符号和空格
+        if isinstance(num, str):
+            num = num.replace('￥', '').replace('¥', '').replace(',', '').strip()
+            if not num:
+                return ''
+
+        # 转换为浮点数
+        amount = float(num)
+
+        # 处理负数
+        if amount < 0:
+            return '负' + number_to_chinese_currency(-amount)
+
+        # 处理零
+        if amount == 0:
+            return '零元整'
+
+        # 中文数字映射
+        chinese_nums = ['零', '壹', '贰', '叁', '肆', '伍', '陆', '柒', '捌', '玖']
+        chinese_units = ['', '拾', '佰', '仟', '万', '拾', '佰', '仟', '亿']
+
+        # 分离整数和小数部分
+        integer_part = int(amount)
+        decimal_part = round((amount - integer_part) * 100)
+
+        result = ''
+
+        # 处理整数部分
+        if integer_part == 0:
+            result = '零元'
+        else:
+            # 转换整数部分
+            integer_str = str(integer_part)
+            length = len(integer_str)
+
+            for i, digit in enumerate(integer_str):
+                digit_num = int(digit)
+                pos = length - i - 1
+
+                if digit_num != 0:
+                    result += chinese_nums[digit_num]
+                    if pos > 0:
+                        if pos == 4:  # 万位
+                            result += '万'
+                        elif pos == 8:  # 亿位
+                            result += '亿'
+                        else:
+                            result += chinese_units[pos % 4]
+                else:
+                    # 处理零的情况
+                    if pos == 4 and result and not result.endswith('万'):
+                        result += '万'
+                    elif pos == 8 and result and not result.endswith('亿'):
+                        result += '亿'
+                    elif i < length - 1 and int(integer_str[i + 1]) != 0 and not result.endswith('零'):
+                        result += '零'
+
+            result += '元'
+
+        # 处理小数部分（角分）
+        if decimal_part == 0:
+            result += '整'
+        else:
+            jiao = decimal_part // 10
+            fen = decimal_part % 10
+
+            if jiao > 0:
+                result += chinese_nums[jiao] + '角'
+
+            if fen > 0:
+                if jiao == 0:
+                    result += '零'
+                result += chinese_nums[fen] + '分'
+
+            if jiao > 0 and fen == 0:
+                result += '整'
+
+        return result
+
+    except (ValueError, TypeError):
+        # 如果转换失败，返回原值
+        return str(num)
+
+def make_variable_resolver(project_data):
+    """根据项目数据生成变量解析函数：变量名 -> 替换文本（无对应数据时返回None）"""
+    def resolve(var_name):
+        # 固定列名映射优先
+        if var_name in FIXED_COLUMN_MAPPING and FIXED_COLUMN_MAPPING[var_name] in project_data:
+            value = project_data[FIXED_COLUMN_MAPPING[var_name]]
+        elif var_name in project_data:
+            value = project_data[var_name]
+        else:
+            return None
+        # 变量名包含"大写"时转换为人民币大写
+        if '大写' in var_name:
+            return number_to_chinese_currency(value)
+        return str(value)
+    return resolve
+
+class RenderContext:
+    """项目渲染上下文：每个项目构建一次，所有模板渲染共用
+    预先完成固定列名映射、取值字符串化和人民币大写转换"""
+
+    def __init__(self, project_data):
+        values = {name: str(value) for name, value in project_data.items()}
+        for template_var, actual_var in FIXED_COLUMN_MAPPING.items():
+            if actual_var in project_data:
+                values[template_var] = values[actual_var]
+        for name, value in project_data.items():
+            if '大写' in name:
+                values[name] = number_to_chinese_currency(value)
+        self.project_data = project_data
+        self.values = values
+
+    def resolve(self, var_name):
+        """变量名 -> 替换文本（无对应数据时返回None）"""
+        return self.values.get(var_name)
+
+def get_variable_resolver(data):
+    """从渲染上下文或项目数据字典获取变量解析函数"""
+    if isinstance(data, RenderContext):
+        return data.resolve
+    return make_variable_resolver(data)
+
+def substitute_variables(text, resolve):
+    """单次正则扫描替换文本中的所有变量，无对应数据的变量保留原样"""
+    def replace_match(match):
+        value = resolve(match.group(1))
+        return match.group(0) if value is None else value
+    return VARIABLE_PATTERN.sub(replace_match, text)
+
+# 替换模板变量的辅助函数
+def replace_template_variables(text, project_data):
+    """替换文本中的模板变量，支持固定列名映射和大写转换"""
+    if not text or not isinstance(text, str):
+        return text
+    if '{{' not in text:
+        return text
+    return substitute_variables(text, get_variable_resolver(project_data))
+
+# 保持格式的Word文档变量替换函数
+def replace_variables_in_paragraph(paragraph, project_data):
+    """在段落中替换变量，保持原有格式"""
+    # 查找段落中的所有变量
+    full_text = paragraph.text
+    if '{{' not in full_text:
+        return
+
+    # 执行替换
+    new_text = substitute_variables(full_text, get_variable_resolver(project_data))
+
+    # 如果文本发生了变化，更新段落
+    if new_text != full_text:
+        # 清除所有runs的文本
+        for run in paragraph.runs:
+            run.text = ''
+
+        # 在第一个run中设置新文本
+        if paragraph.runs:
+            paragraph.runs[0].text = new_text
+        else:
+            # 如果没有runs，创建一个新的
+            paragraph.add_run(new_text)
+
+def replace_variables_in_table_cell(cell, project_data):
+    """在表格单元格中替换变量，保持原有格式"""
+    for paragraph in cell.paragraphs:
+        replace_variables_in_paragraph(paragraph, project_data)
+
+# ==================== OOXML直接替换引擎 ====================
+
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+S_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+R_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+W_P = f'{{{W_NS}}}p'
+W_R = f'{{{W_NS}}}r'
+W_T = f'{{{W_NS}}}t'
+W_RPR = f'{{{W_NS}}}rPr'
+S_SI = f'{{{S_NS}}}si'
+
+# 需要替换变量的Word部件：正文、页眉、页脚
+DOCX_TEXT_PART_PATTERN = re.compile(r'^word/(document|header\d*|footer\d*)\.xml$')
+
+# Excel中可能包含变量的部件：共享字符串表、含内联字符串的工作表
+XLSX_SHARED_STRINGS_PART = 'xl/sharedStrings.xml'
+XLSX_SHEET_PART_PATTERN = re.compile(r'^xl/worksheets/sheet\d+\.xml$')
+
+# 段落内的文本节点：直接子run及超链接、修订等一层容器中的run（不含文本框内的嵌套段落）
+_paragraph_text_nodes = etree.XPath('./w:r/w:t | ./*/w:r/w:t', namespaces={'w': W_NS})
+_paragraph_runs = etree.XPath('./w:r | ./*/w:r', namespaces={'w': W_NS})
+
+# 共享字符串/内联字符串的文本节点：纯文本或富文本run（不含拼音注音）
+_string_item_text_nodes = etree.XPath('./s:t | ./s:r/s:t', namespaces={'s': S_NS})
+_inline_string_items = etree.XPath('.//s:c[@t="inlineStr"]/s:is', namespaces={'s': S_NS})
+
+def _is_docx_text_part(name, data):
+    # 变量可能被拆分到多个run中，只要包含"{"就需要解析
+    return bool(DOCX_TEXT_PART_PATTERN.match(name)) and b'{' in data
+
+def _is_xlsx_text_part(name, data):
+    if name == XLSX_SHARED_STRINGS_PART:
+        return b'{' in data
+    return bool(XLSX_SHEET_PART_PATTERN.match(name)) and b'inlineStr' in data and b'{' in data
+
+def rewrite_text_nodes(text_nodes, resolve):
+    """在一组连续的文本节点中替换变量，变量跨节点时替换值写入变量起始节点，返回是否有修改"""
+    texts = [node.text or '' for node in text_nodes]
+    full_text = ''.join(texts)
+    if '{{' not in full_text:
+        return False
+
+    replacements = []
+    for match in VARIABLE_PATTERN.finditer(full_text):
+        value = resolve(match.group(1))
+        if value is not None:
+            replacements.append((match.start(), match.end(), value))
+    if not replacements:
+        return False
+
+    offset = 0
+    for node, text in zip(text_nodes, texts):
+        node_end = offset + len(text)
+        pieces = []
+        pos = offset
+        for start, end, value in replacements:
+            if end <= offset or start >= node_end:
+                continue
+            if start >= offset:
+                pieces.append(full_text[pos:start])
+                pieces.append(value)
+            pos = min(end, node_end)
+        pieces.append(full_text[pos:node_end])
+        new_text = ''.join(pieces)
+        if new_text != text:
+            node.text = new_text
+            node.set(XML_SPACE, 'preserve')
+        offset = node_end
+    return True
+
+def merge_split_placeholders(text_nodes):
+    """将跨多个文本节点的变量合并到变量起始节点（保留起始run的格式），删除因此变空的run，返回是否有修改"""
+    texts = [node.text or '' for node in text_nodes]
+    # 变量原样写回起始节点，其余节点中的变量片段被移除
+    if not rewrite_text_nodes(text_nodes, lambda name: f'{{{{{name}}}}}'):
+        return False
+
+    changed = False
+    for node, text in zip(text_nodes, texts):
+        if (node.text or '') == text:
+            continue
+        changed = True
+        run = node.getparent()
+        if not node.text and run.tag == W_R and all(child is node or child.tag == W_RPR for child in run):
+            run.getparent().remove(run)
+    return changed
+
+def replace_variables_in_planned_paragraph(paragraph, entry, resolve):
+    """按计划条目替换段落中的变量：变量都在单个run内时只改写这些run，否则整段改写"""
+    if entry is not None and not entry['spans_runs']:
+        runs = _paragraph_runs(paragraph)
+        if all(index < len(runs) for index in entry['runs']):
+            for index in entry['runs']:
+                rewrite_text_nodes(runs[index].findall(W_T), resolve)
+            return
+    rewrite_text_nodes(_paragraph_text_nodes(paragraph), resolve)
+
+def replace_variables_in_part(root, resolve, plan_entries=None):
+    """替换Word XML部件中段落的变量，有渲染计划时只处理计划中的段落"""
+    if plan_entries is None:
+        for paragraph in root.iter(W_P):
+            rewrite_text_nodes(_paragraph_text_nodes(paragraph), resolve)
+        return
+    for paragraph, entry in select_planned_nodes(list(root.iter(W_P)), plan_entries, 'paragraph'):
+        replace_variables_in_planned_paragraph(paragraph, entry, resolve)
+
+def replace_variables_in_sheet_part(name, root, resolve, plan_entries=None):
+    """替换Excel共享字符串表或工作表内联字符串中的变量，有渲染计划时只处理计划中的字符串项"""
+    if name == XLSX_SHARED_STRINGS_PART:
+        string_items = root.findall(S_SI)
+    else:
+        string_items = _inline_string_items(root)
+    if plan_entries is not None:
+        string_items = [node for node, _ in select_planned_nodes(string_items, plan_entries, 'item')]
+    for string_item in string_items:
+        rewrite_text_nodes(_string_item_text_nodes(string_item), resolve)
+
+def read_raw_entry(fp, info):
+    """读取压缩包条目的原始压缩数据（不解压）"""
+    fp.seek(info.header_offset)
+    header = fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+    return fp.read(info.compress_size)
+
+def write_raw_entry(zf, info, raw):
+    """将原始压缩数据直接写入压缩包，跳过解压和重新压缩"""
+    # 使用新的ZipInfo，避免多线程共享缓存中的ZipInfo
+    entry = zipfile.ZipInfo(info.filename, info.date_time)
+    entry.compress_type = info.compress_type
+    entry.external_attr = info.external_attr
+    entry.CRC = info.CRC
+    entry.compress_size = info.compress_size
+    entry.file_size = info.file_size
+    entry.header_offset = zf.fp.tell()
+    zf.fp.write(entry.FileHeader())
+    zf.fp.write(raw)
+    zf.filelist.append(entry)
+    zf.NameToInfo[entry.filename] = entry
+    zf.start_dir = zf.fp.tell()
+
+class OoxmlPackage:
+    """OOXML压缩包：未修改的部件保存原始压缩数据，仅解析包含变量的XML部件"""
+
+    def __init__(self, entries, parts):
+        self.entries = entries  # [(ZipInfo, 原始压缩数据)]
+        self.parts = parts      # 部件名 -> 解析后的XML根节点
+
+    @classmethod
+    def load(cls, file_path, is_text_part):
+        entries = []
+        parts = {}
+        with open(file_path, 'rb') as fp, zipfile.ZipFile(fp) as zf:
+            for info in zf.infolist():
+                data = zf.read(info)
+                if is_text_part(info.filename, data):
+                    parts[info.filename] = etree.fromstring(data)
+                    entries.append((info, None))
+                else:
+                    entries.append((info, read_raw_entry(fp, info)))
+        return cls(entries, parts)
+
+    def size(self):
+        """估算内存占用（原始数据 + 解析部件解压后大小）"""
+        return sum(len(raw) if raw is not None else info.file_size for info, raw in self.entries)
+
+    def clone(self):
+        """复制可修改副本，只深拷贝需要替换的XML部件，其余部件数据共享"""
+        return OoxmlPackage(self.entries, {name: copy.deepcopy(root) for name, root in self.parts.items()})
+
+    def save(self, output):
+        """写出压缩包，未修改的部件直接复制原始压缩数据"""
+        with zipfile.ZipFile(output, 'w') as zf:
+            for info, raw in self.entries:
+                if raw is not None:
+                    write_raw_entry(zf, info, raw)
+                    continue
+                data = etree.tostring(self.parts[info.filename], xml_declaration=True,
+                                      encoding='UTF-8', standalone=True)
+                entry = zipfile.ZipInfo(info.filename, info.date_time)
+                entry.compress_type = info.compress_type
+                entry.external_attr = info.external_attr
+                zf.writestr(entry, data)
+
+# ==================== 渲染计划 ====================
+#
+# 上传模板时记录每个变量所在的位置，保存到模板记录中：
+#   Word:  {"parts": {"word/document.xml": [{"paragraph": 段落序号, "runs": [run序号],
+#                                            "spans_runs": 是否跨run, "variables": [变量名]}]}}
+#   Excel: {"parts": {"xl/sharedStrings.xml": [{"item": 字符串序号, ...}],
+#                     "xl/worksheets/sheet1.xml": [{"item": 内联字符串序号, "cell": "B2", ...}]},
+#           "cells": [{"sheet": 工作表名, "cell": "B2"}]}
+# 生成文件时只访问计划中的节点，计划缺失或与模板不一致时退回全量扫描。
+
+RENDER_PLAN_VERSION = 1
+
+_string_item_runs = etree.XPath('./s:t | ./s:r', namespaces={'s': S_NS})
+
+def _locate_placeholders(text_nodes, runs):
+    """定位一组文本节点中的变量，返回变量名、涉及的run序号及是否跨run"""
+    texts = [node.text or '' for node in text_nodes]
+    full_text = ''.join(texts)
+    if '{{' not in full_text:
+        return None
+    matches = list(VARIABLE_PATTERN.finditer(full_text))
+    if not matches:
+        return None
+
+    run_index = {run: index for index, run in enumerate(runs)}
+    spans = []
+    offset = 0
+    for node, text in zip(text_nodes, texts):
+        parent = node if node in run_index else node.getparent()
+        spans.append((offset, offset + len(text), run_index.get(parent, 0)))
+        offset += len(text)
+
+    used_runs = set()
+    spans_runs = False
+    for match in matches:
+        covering = {run for start, end, run in spans if start < match.end() and end > match.start()}
+        spans_runs = spans_runs or len(covering) > 1
+        used_runs |= covering
+    return {
+        'runs': sorted(used_runs),
+        'spans_runs': spans_runs,
+        'variables': [match.group(1) for match in matches]
+    }
+
+def _build_docx_render_plan(file_path):
+    parts = {}
+    with zipfile.ZipFile(file_path) as zf:
+        for name in zf.namelist():
+            data = zf.read(name)
+            if not _is_docx_text_part(name, data):
+                continue
+            entries = []
+            for index, paragraph in enumerate(etree.fromstring(data).iter(W_P)):
+                entry = _locate_placeholders(_paragraph_text_nodes(paragraph), _paragraph_runs(paragraph))
+                if entry:
+                    entry['paragraph'] = index
+                    entries.append(entry)
+            if entries:
+                parts[name] = entries
+    return {'version': RENDER_PLAN_VERSION, 'parts': parts}
+
+def _xlsx_sheet_titles(zf):
+    """工作表部件名 -> 工作表名称"""
+    workbook = etree.fromstring(zf.read('xl/workbook.xml'))
+    relationships = etree.fromstring(zf.read('xl/_rels/workbook.xml.rels'))
+    targets = {rel.get('Id'): rel.get('Target') for rel in relationships}
+    titles = {}
+    for sheet in workbook.iter(f'{{{S_NS}}}sheet'):
+        target = targets.get(sheet.get(f'{{{R_NS}}}id'))
+        if not target:
+            continue
+        if target.startswith('/'):
+            part_name = target.lstrip('/')
+        else:
+            part_name = posixpath.normpath(posixpath.join('xl', target))
+        titles[part_name] = sheet.get('name')
+    return titles
+
+def _build_xlsx_render_plan(file_path):
+    parts = {}
+    cells = []
+    with zipfile.ZipFile(file_path) as zf:
+        names = zf.namelist()
+        sheet_titles = _xlsx_sheet_titles(zf)
+
+        # 共享字符串表中包含变量的字符串项
+        shared_items = set()
+        if XLSX_SHARED_STRINGS_PART in names:
+            data = zf.read(XLSX_SHARED_STRINGS_PART)
+            if b'{' in data:
+                entries = []
+                for index, string_item in enumerate(etree.fromstring(data).findall(S_SI)):
+                    entry = _locate_placeholders(_string_item_text_nodes(string_item), _string_item_runs(string_item))
+                    if entry:
+                        entry['item'] = index
+                        entries.append(entry)
+                        shared_items.add(index)
+                if entries:
+                    parts[XLSX_SHARED_STRINGS_PART] = entries
+
+        # 引用这些字符串项的单元格，以及包含变量的内联字符串单元格
+        for name in names:
+            if not XLSX_SHEET_PART_PATTERN.match(name):
+                continue
+            data = zf.read(name)
+            has_inline = b'inlineStr' in data and b'{' in data
+            if not shared_items and not has_inline:
+                continue
+            title = sheet_titles.get(name)
+            entries = []
+            inline_index = 0
+            for cell in etree.fromstring(data).iter(f'{{{S_NS}}}c'):
+                cell_type = cell.get('t')
+                if cell_type == 's' and shared_items:
+                    value = cell.find(f'{{{S_NS}}}v')
+                    if value is not None and value.text and int(value.text) in shared_items:
+                        cells.append({'sheet': title, 'cell': cell.get('r')})
+                elif cell_type == 'inlineStr':
+                    string_item = cell.find(f'{{{S_NS}}}is')
+                    if string_item is None:
+                        continue
+                    entry = _locate_placeholders(_string_item_text_nodes(string_item), _string_item_runs(string_item))
+                    if entry:
+                        entry['item'] = inline_index
+                        entry['cell'] = cell.get('r')
+                        entries.append(entry)
+                        cells.append({'sheet': title, 'cell': cell.get('r')})
+                    inline_index += 1
+            if entries:
+                parts[name] = entries
+
+    # 无法确定工作表名称或单元格坐标时，对象模型引擎退回全量扫描
+    if any(not item['sheet'] or not item['cell'] for item in cells):
+        cells = None
+    return {'version': RENDER_PLAN_VERSION, 'parts': parts, 'cells': cells}
+
+def normalize_docx_template(file_path):
+    """上传时规整Word模板：被拆分到多个run中的变量合并到一个run，规整后的模板覆盖原文件，返回处理的段落数"""
+    package = OoxmlPackage.load(file_path, _is_docx_text_part)
+    merged = 0
+    for root in package.parts.values():
+        for paragraph in root.iter(W_P):
+            if merge_split_placeholders(_paragraph_text_nodes(paragraph)):
+                merged += 1
+    if merged:
+        temp_path = f'{file_path}.tmp'
+        package.save(temp_path)
+        os.replace(temp_path, file_path)
+    return merged
+
+def build_render_plan(file_path, file_type):
+    """分析模板中变量的位置，生成渲染计划，不支持的类型返回None"""
+    if file_type == '.docx':
+        return _build_docx_render_plan(file_path)
+    if file_type == '.xlsx':
+        return _build_xlsx_render_plan(file_path)
+    return None
+
+def dump_render_plan(render_plan):
+    """序列化渲染计划，用于保存到数据库"""
+    if render_plan is None:
+        return None
+    return json.dumps(render_plan, ensure_ascii=False, separators=(',', ':'))
+
+def load_render_plan(text):
+    """解析数据库中保存的渲染计划，缺失、损坏或版本不符时返回None"""
+    if not text:
+        return None
+    try:
+        render_plan = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(render_plan, dict) or render_plan.get('version') != RENDER_PLAN_VERSION:
+        return None
+    return render_plan
+
+def plan_entries_for_part(render_plan, part_name):
+    """获取指定部件的计划条目，无渲染计划时返回None（全量扫描）"""
+    if render_plan is None:
+        return None
+    return render_plan['parts'].get(part_name, [])
+
+def select_planned_nodes(nodes, plan_entries, key):
+    """按计划条目中的序号选取节点，返回(节点, 计划条目)列表；序号超出范围说明计划已过期，返回全部节点"""
+    selected = []
+    for entry in plan_entries:
+        index = entry[key]
+        if index >= len(nodes):
+            return [(node, None) for node in nodes]
+        selected.append((nodes[index], entry))
+    return selected
+
+def _docx_part_element(doc, part_name):
+    """获取python-docx文档中指定部件的XML根节点"""
+    if part_name == 'word/document.xml':
+        return doc.element
+    partname = '/' + part_name
+    for part in doc.part.package.iter_parts():
+        if part.partname == partname:
+            return getattr(part, 'element', None)
+    return None
+
+def _docx_text_part_elements(doc):
+    """python-docx文档中可能包含变量的部件（正文、页眉、页脚）的XML根节点，与渲染计划覆盖的部件相同"""
+    yield doc.element
+    for part in doc.part.package.iter_parts():
+        part_name = part.partname.lstrip('/')
+        if part_name != 'word/document.xml' and DOCX_TEXT_PART_PATTERN.match(part_name):
+            element = getattr(part, 'element', None)
+            if element is not None:
+                yield element
+
+# ==================== 模板缓存 ====================
+
+def _zip_uncompressed_size(file_path):
+    """计算OOXML压缩包解压后的总大小，作为缓存占用的估算值"""
+    try:
+        with zipfile.ZipFile(file_path) as zf:
+            return sum(info.file_size for info in zf.infolist())
+    except zipfile.BadZipFile:
+        return os.path.getsize(file_path)
+
+def _load_docx_template(file_path):
+    """解析Word模板，缓存解析后的文档对象，取用时深拷贝"""
+    return Document(file_path), _zip_uncompressed_size(file_path)
+
+def _load_xlsx_template(file_path):
+    """读取Excel模板字节内容（openpyxl工作簿无法安全深拷贝，取用时从内存重新加载）"""
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    return data, len(data)
+
+def _load_docx_package(file_path):
+    """按OOXML部件加载Word模板"""
+    package = OoxmlPackage.load(file_path, _is_docx_text_part)
+    return package, package.size()
+
+def _load_xlsx_package(file_path):
+    """按OOXML部件加载Excel模板"""
+    package = OoxmlPackage.load(file_path, _is_xlsx_text_part)
+    return package, package.size()
+
+# 模板加载器：模板类别 -> (加载函数, 克隆函数)
+TEMPLATE_LOADERS = {
+    'docx': (_load_docx_template, copy.deepcopy),
+    'xlsx': (_load_xlsx_template, lambda data: load_workbook(io.BytesIO(data))),
+    'docx-ooxml': (_load_docx_package, OoxmlPackage.clone),
+    'xlsx-ooxml': (_load_xlsx_package, OoxmlPackage.clone),
+}
+
+class TemplateCache:
+    """进程级模板缓存：保存解析后的原始模板，按LRU淘汰，渲染时取克隆副本"""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (模板ID, 模板类别) -> (文件签名, 占用大小, 原始模板)
+        self._lock = threading.Lock()
+
+    def _file_signature(self, file_path):
+        """文件签名：修改时间+大小，文件被替换后缓存自动失效"""
+        stat = os.stat(file_path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def checkout(self, template_id, file_path, kind):
+        """获取可修改的模板副本"""
+        loader, cloner = TEMPLATE_LOADERS[kind]
+        key = (template_id, kind)
+        signature = self._file_signature(file_path)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                pristine = entry[2]
+            else:
+                if entry:
+                    self._remove(key)
+                self.misses += 1
+                pristine = None
+
+        if pristine is not None:
+            return cloner(pristine)
+
+        pristine, size = loader(file_path)
+        if size > self.max_bytes:
+            # 超过缓存上限的模板不缓存，直接使用解析结果
+            return cloner(pristine) if kind == 'xlsx' else pristine
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (signature, size, pristine)
+            self.current_bytes += size
+            self._evict()
+
+        return cloner(pristine)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def _evict(self):
+        """按最近最少使用顺序淘汰，直到占用不超过上限"""
+        while self.current_bytes > self.max_bytes and self._entries:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+
+    def set_max_bytes(self, max_bytes):
+        """调整缓存上限"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def invalidate(self, template_id):
+        """删除指定模板的所有缓存条目"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == template_id]:
+                self._remove(key)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """获取缓存统计信息"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size_mb': round(self.current_bytes / (1024 * 1024), 2),
+                'max_size_mb': round(self.max_bytes / (1024 * 1024), 2),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+# 全局模板缓存实例
+template_cache = TemplateCache()
+
+# ==================== 文件渲染 ====================
+
+# 支持生成的模板类型
+RENDERABLE_TYPES = ('.docx', '.xlsx', '.xls')
+
+def render_template_file(template_id, template_path, file_type, project_data, output, render_plan=None):
+    """使用模板和项目数据生成文件，project_data可以是数据字典或渲染上下文，output可以是文件路径或文件对象
+
+    render_plan为上传时生成的渲染计划，提供时只访问计划中记录的变量位置
+    """
+    if isinstance(project_data, RenderContext):
+        render_context = project_data
+    else:
+        render_context = RenderContext(project_data)
+
+    if file_type == '.docx' and render_options['docx_engine'] == 'ooxml':
+        # 直接改写包含变量的XML部件，其余部件原样复制
+        package = template_cache.checkout(template_id, template_path, 'docx-ooxml')
+        for name, root in package.parts.items():
+            replace_variables_in_part(root, render_context.resolve, plan_entries_for_part(render_plan, name))
+        package.save(output)
+
+    elif file_type == '.docx':
+        # 处理Word文档，保持原有格式
+        doc = template_cache.checkout(template_id, template_path, 'docx')
+
+        if render_plan is not None:
+            # 按渲染计划只处理包含变量的段落（含页眉页脚）
+            for part_name, plan_entries in render_plan['parts'].items():
+                element = _docx_part_element(doc, part_name)
+                if element is None:
+                    continue
+                for p, entry in select_planned_nodes(list(element.iter(W_P)), plan_entries, 'paragraph'):
+                    if entry is not None and not entry['spans_runs']:
+                        # 变量位于单个run内（上传时已规整），直接替换run文本
+                        replace_variables_in_planned_paragraph(p, entry, render_context.resolve)
+                    else:
+                        replace_variables_in_paragraph(Paragraph(p, None), render_context)
+        else:
+            # 没有渲染计划时扫描计划覆盖的全部部件（含页眉页脚、嵌套表格），结果与按计划渲染一致
+            for element in _docx_text_part_elements(doc):
+                for p in element.iter(W_P):
+                    replace_variables_in_paragraph(Paragraph(p, None), render_context)
+
+        doc.save(output)
+
+    elif file_type == '.xlsx' and render_options['xlsx_engine'] == 'ooxml':
+        # 只改写共享字符串表和内联字符串，其余部件原样复制
+        package = template_cache.checkout(template_id, template_path, 'xlsx-ooxml')
+        for name, root in package.parts.items():
+            replace_variables_in_sheet_part(name, root, render_context.resolve,
+                                            plan_entries_for_part(render_plan, name))
+        package.save(output)
+
+    elif file_type in ['.xlsx', '.xls']:
+        # 处理Excel文档
+        wb = template_cache.checkout(template_id, template_path, 'xlsx')
+
+        if render_plan is not None and render_plan.get('cells') is not None:
+            # 按渲染计划只处理包含变量的单元格
+            cells = (wb[item['sheet']][item['cell']] for item in render_plan['cells']
+                     if item['sheet'] in wb.sheetnames)
+        else:
+            cells = (cell for sheet in wb.worksheets for row in sheet.iter_rows() for cell in row)
+
+        for cell in cells:
+            if cell.value and isinstance(cell.value, str):
+                cell.value = replace_template_variables(cell.value, render_context)
+
+        wb.save(output)
+
+# ==================== 内容摘要 ====================
+
+# 计算内容摘要时忽略的部件：文档属性中的保存时间每次生成都不同
+DIGEST_IGNORED_PARTS = {'docProps/core.xml'}
+
+def content_digest(data):
+    """计算生成文件的内容摘要：Word/Excel（ZIP包）按各部件的名称和解压后内容计算，忽略ZIP条目时间和文档保存时间
+
+    同一文档在不同时间生成时只有这些时间不同，按字节计算无法去重
+    """
+    if data[:4] == b'PK\x03\x04':
+        try:
+            digest = hashlib.sha256(b'zip\0')
+            with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                for info in zf.infolist():
+                    if info.filename in DIGEST_IGNORED_PARTS:
+                        continue
+                    digest.update(info.filename.encode('utf-8') + b'\0')
+                    digest.update(f'{info.file_size}\0'.encode('ascii'))
+                    digest.update(zf.read(info))
+            return digest.hexdigest()
+        except (zipfile.BadZipFile, OSError, ValueError):
+            pass
+    return hashlib.sha256(data).hexdigest()
+
+# ==================== 批量渲染 ====================
+
+def _init_render_worker(options, cache_max_bytes):
+    """进程池工作进程初始化：同步主进程的渲染配置"""
+    render_options.update(options)
+    template_cache.set_max_bytes(cache_max_bytes)
+
+def replace_file(path, data):
+    """写入临时文件后替换path：原文件可能是内容寻址存储中共用内容的硬链接，不能原地改写"""
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def render_job(job):
+    """渲染一个(项目, 模板)任务，失败时返回错误信息而不抛出异常
+
+    job['return_data']为True时在内存中渲染并通过result['data']返回文件内容（output_path不为空时同时保存一份），
+    job['digest']为True时同时通过result['digest']返回内容摘要；
+    成功时result['render_seconds']为渲染耗时
+    """
+    result = {
+        'project_id': job['project_id'],
+        'template_id': job['template_id'],
+        'output_path': job['output_path'],
+        'arcname': job.get('arcname')
+    }
+    started = time.perf_counter()
+    try:
+        buffer = io.BytesIO()
+        render_template_file(job['template_id'], job['template_path'], job['file_type'],
+                             job['project_data'], buffer, job.get('render_plan'))
+        data = buffer.getvalue()
+        if job['output_path']:
+            replace_file(job['output_path'], data)
+        if job.get('return_data'):
+            result['data'] = data
+            if job.get('digest'):
+                # 在工作进程中计算内容摘要，主进程写入内容寻址存储时不再解压计算
+                result['digest'] = content_digest(data)
+        result['success'] = True
+        result['render_seconds'] = time.perf_counter() - started
+    except Exception as e:
+        result['success'] = False
+        result['error'] = str(e)
+    return result
+
+def _failed_result(job, error):
+    return {
+        'project_id': job['project_id'],
+        'template_id': job['template_id'],
+        'output_path': job['output_path'],
+        'arcname': job.get('arcname'),
+        'success': False,
+        'error': error
+    }
+
+class RenderPool:
+    """批量渲染执行器：workers为1时在当前线程顺序执行，大于1时使用进程池并行渲染
+
+    window为同时在途（已提交但结果尚未被取走）的任务数上限，内存渲染时限制驻留内存的文件数量
+    """
+
+    def __init__(self, workers=1, window=8):
+        self.workers = workers
+        self.window = window
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def set_workers(self, workers):
+        """调整工作进程数，已有进程池在下次使用时按新配置重建"""
+        with self._lock:
+            self.workers = max(1, workers)
+            self._shutdown()
+
+    def set_window(self, window):
+        """调整在途任务数上限（不小于工作进程数）"""
+        self.window = max(1, window)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=_init_render_worker,
+                    initargs=(dict(render_options), template_cache.max_bytes)
+                )
+            return self._executor
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def shutdown(self):
+        """关闭进程池"""
+        with self._lock:
+            self._shutdown()
+
+    def run(self, jobs):
+        """执行渲染任务，按完成顺序逐个返回结果；生成器被关闭时撤销未开始的任务"""
+        if self.workers <= 1 or len(jobs) <= 1:
+            for job in jobs:
+                yield render_job(job)
+            return
+
+        executor = self._get_executor()
+        remaining = iter(jobs)
+        pending = {}      # 在途任务：future -> job
+        rejected = []     # 无法提交的任务（进程池已损坏）
+
+        def submit_next():
+            for job in remaining:
+                try:
+                    pending[executor.submit(render_job, job)] = job
+                    return
+                except Exception as e:
+                    rejected.append(_failed_result(job, f'渲染进程异常: {e}'))
+
+        for _ in range(max(self.window, self.workers)):
+            submit_next()
+
+        try:
+            while pending or rejected:
+                while rejected:
+                    yield rejected.pop(0)
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # 工作进程异常退出时进程池不可再用，下次使用时重建
+                        with self._lock:
+                            if self._executor is executor:
+                                self._shutdown()
+                        result = _failed_result(job, f'渲染进程异常: {e}')
+                    # 结果取走前补充一个任务，保持在途任务数不超过上限
+                    submit_next()
+                    yield result
+        finally:
+            # 调用方提前结束（如任务被取消）时，撤销尚未开始的任务
+            for future in pending:
+                future.cancel()
+
+# 全局批量渲染执行器
+render_pool = RenderPool()
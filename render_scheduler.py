@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import zipfile
+from datetime import datetime
+from functools import lru_cache
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 结构估算的权重：每KB模板文件、每个XML部件、每个变量占位符各计多少成本单位
+COST_PER_KB = 1.0
+COST_PER_PART = 2.0
+COST_PER_PLACEHOLDER = 0.5
+
+@lru_cache(maxsize=1024)
+def _read_profile(template_path, mtime_ns, size):
+    part_count = 0
+    placeholder_count = 0
+    try:
+        with zipfile.ZipFile(template_path) as zf:
+            for info in zf.infolist():
+                if not info.filename.endswith(('.xml', '.rels')):
+                    continue
+                part_count += 1
+                placeholder_count += zf.read(info).count(b'{{')
+    except (zipfile.BadZipFile, OSError):
+        pass
+    return size, part_count, placeholder_count
+
+def template_profile(template_path):
+    """模板的结构特征：(文件大小, XML部件数, 变量占位符数)，按文件修改时间缓存"""
+    try:
+        stat = os.stat(template_path)
+    except OSError:
+        return 0, 0, 0
+    return _read_profile(template_path, stat.st_mtime_ns, stat.st_size)
+
+def structural_cost(profile):
+    """按模板结构估算的渲染成本（成本单位）"""
+    size, part_count, placeholder_count = profile
+    return size / 1024 * COST_PER_KB + part_count * COST_PER_PART + placeholder_count * COST_PER_PLACEHOLDER
+
+def estimate_template_costs(templates, render_seconds):
+    """估算各模板一次渲染的耗时（秒）
+
+    templates为{模板ID: 模板路径}，render_seconds为有历史记录的模板的平均渲染耗时；
+    有记录的模板直接使用历史耗时，其余模板按结构估算，并用有记录模板的 耗时/结构成本 比例换算为秒
+    """
+    structural = {template_id: structural_cost(template_profile(path)) for template_id, path in templates.items()}
+    measured = [template_id for template_id in structural if template_id in render_seconds]
+    measured_units = sum(structural[template_id] for template_id in measured)
+    seconds_per_unit = (sum(render_seconds[template_id] for template_id in measured) / measured_units
+                        if measured_units > 0 else 1.0)
+    return {
+        template_id: render_seconds[template_id] if template_id in render_seconds else units * seconds_per_unit
+        for template_id, units in structural.items()
+    }
+
+def schedule_longest_first(jobs, render_seconds):
+    """按估算耗时从长到短排列渲染任务（耗时相同时保持原顺序）
+
+    进程池按提交顺序取任务，耗时最长的任务先开始，批量末尾只剩短任务，避免个别大文件最后单独渲染拖长总时间
+    """
+    costs = estimate_template_costs({job['template_id']: job['template_path'] for job in jobs}, render_seconds)
+    return sorted(jobs, key=lambda job: -costs[job['template_id']])
+
+class RenderStats:
+    """各模板的历史渲染耗时（保存在SQLite中），渲染完成后更新，供批量生成估算任务耗时
+
+    平均耗时按最近window次渲染滑动更新，模板或渲染环境变化后逐步跟上新的耗时
+    """
+
+    def __init__(self, db_path='system.db', window=20):
+        self.db_path = db_path
+        self.window = window
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def averages(self, template_ids):
+        """返回{模板ID: 平均渲染耗时(秒)}，没有记录的模板不在结果中"""
+        template_ids = list(dict.fromkeys(template_ids))
+        if not template_ids:
+            return {}
+        conn = self._connect()
+        try:
+            result = {}
+            for start in range(0, len(template_ids), 500):
+                chunk = template_ids[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT template_id, avg_seconds FROM template_render_stats "
+                    f"WHERE template_id IN ({', '.join('?' * len(chunk))})", chunk
+                )
+                result.update(rows)
+            return result
+        finally:
+            conn.close()
+
+    def record(self, samples):
+        """记录渲染耗时，samples为{模板ID: [耗时(秒), ...]}"""
+        if not samples:
+            return
+        conn = self._connect()
+        try:
+            existing = {}
+            template_ids = list(samples)
+            for start in range(0, len(template_ids), 500):
+                chunk = template_ids[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT template_id, render_count, avg_seconds FROM template_render_stats "
+                    f"WHERE template_id IN ({', '.join('?' * len(chunk))})", chunk
+                )
+                existing.update((row[0], (row[1], row[2])) for row in rows)
+
+            now = datetime.now().strftime(TIME_FORMAT)
+            for template_id, seconds_list in samples.items():
+                count, average = existing.get(template_id, (0, 0.0))
+                for seconds in seconds_list:
+                    count += 1
+                    average += (seconds - average) / min(count, self.window)
+                conn.execute('''
+                    INSERT OR REPLACE INTO template_render_stats
+                        (template_id, render_count, avg_seconds, last_seconds, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (template_id, count, average, seconds_list[-1], now))
+            conn.commit()
+        finally:
+            conn.close()
@@ -0,0 +1,73 @@
+import os
+import sys
+
+import pytest
+from docx import Document
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module
+from batch_jobs import BatchJobManager
+from output_cache import BlobStore, OutputCache, file_sha256
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """使用临时数据库和输出目录的测试客户端（管理员已登录）"""
+    output_dir = str(tmp_path / 'output')
+    blob_store = BlobStore(os.path.join(output_dir, '.blobs'))
+    monkeypatch.setattr(app_module, 'app_path', str(tmp_path))
+    monkeypatch.setitem(app_module.app.config, 'OUTPUT_FOLDER', output_dir)
+    monkeypatch.setattr(app_module, 'blob_store', blob_store)
+    monkeypatch.setattr(app_module, 'output_cache', OutputCache(str(tmp_path / 'system.db'), blob_store))
+    monkeypatch.setattr(app_module, 'batch_job_manager', BatchJobManager(str(tmp_path / 'system.db')))
+    app_module.init_db()
+
+    template_path = str(tmp_path / 'notice.docx')
+    doc = Document()
+    doc.add_paragraph('金额：{{金额}}')
+    doc.save(template_path)
+    conn = app_module.get_db_connection()
+    conn.execute('INSERT INTO templates (name, filename, file_path, file_type, content_hash) VALUES (?, ?, ?, ?, ?)',
+                 ('通知', 'notice.docx', template_path, '.docx', file_sha256(template_path)))
+    for project_id in (1, 2):
+        # 两个项目的名称和数据相同，生成的文件内容相同
+        conn.execute('INSERT INTO projects (id, name, contract_number, created_by) VALUES (?, ?, ?, 1)',
+                     (project_id, '同名项目', ''))
+        conn.execute('INSERT INTO project_data (project_id, variable_name, variable_value) VALUES (?, ?, ?)',
+                     (project_id, '金额', '100'))
+    conn.commit()
+    conn.close()
+
+    app_module.app.config['TESTING'] = True
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+        session['role'] = 'admin'
+        session['username'] = 'admin'
+    return client
+
+def document_text(path):
+    return [paragraph.text for paragraph in Document(path).paragraphs]
+
+def generate(client, project_id, **additional_data):
+    result = client.post('/generate_file', json={
+        'project_id': project_id, 'template_id': 1, 'additional_data': additional_data
+    }).get_json()
+    assert result['success'], result
+    return result
+
+def test_regenerate_does_not_change_shared_content(client):
+    first = generate(client, 1)
+    second = generate(client, 2)
+    # 内容相同的文件共用内容寻址存储中的同一份内容
+    assert os.path.samefile(first['file_path'], second['file_path'])
+
+    regenerated = generate(client, 1, 金额='999')
+    assert not regenerated['cached']
+    assert document_text(regenerated['file_path']) == ['金额：999']
+
+    # 另一个项目的文件和缓存不受影响
+    assert document_text(second['file_path']) == ['金额：100']
+    again = generate(client, 2)
+    assert again['cached']
+    assert document_text(again['file_path']) == ['金额：100']